@@ -0,0 +1,534 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from app.constant import target_assets, n_label
+from app.data import load_data, build_store, get_classification_data, load_panel
+from app.model import get_rnn_data, get_model, search_threshold, get_xgb_classification_params, xgb_param_selection
+
+
+# Run func(*args) repeat times: best wall time in seconds and peak traced memory in bytes (None without
+# tracemalloc)
+def measure(func, args=(), repeat=5, trace_memory=True):
+    seconds = []
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        seconds.append(time.time() - start)
+    tracemalloc = get_tracemalloc() if trace_memory else None
+    if tracemalloc is None:
+        return min(seconds), None
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+# tracemalloc is python 3 only: None when memory can not be traced
+def get_tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    return tracemalloc
+
+
+def print_report(rows, fields):
+    print('\t'.join(fields))
+    for row in rows:
+        print('\t'.join('{:.6f}'.format(v) if isinstance(v, float) else str(v) for v in row))
+
+
+###############
+# RNN data
+###############
+# Window building before the strided view: one copy per sequence
+def get_rnn_data_copy(xs, ys, length=20):
+    sequence_xs = []
+    for i in range(len(xs) - length + 1):
+        sequence_xs.append(xs[i:i + length])
+    sequence_xs = np.array(sequence_xs)
+    if len(ys):
+        sequence_ys = np.array(ys[length - 1:])
+        sequence_ys = sequence_ys.reshape(sequence_ys.shape[0], 1)
+    else:
+        sequence_ys = None
+    return sequence_xs, sequence_ys
+
+
+def benchmark_rnn_data(length=20):
+    rows = []
+    for asset in target_assets:
+        d = load_data(asset)
+        xs = d.iloc[:, :-n_label].values
+        ys = list((d.iloc[:, -1] > 0).astype(int))
+        copy_seconds, copy_bytes = measure(get_rnn_data_copy, (xs, ys, length))
+        view_seconds, view_bytes = measure(get_rnn_data, (xs, ys, length))
+        assert np.array_equal(get_rnn_data_copy(xs, ys, length)[0], get_rnn_data(xs, ys, length)[0])
+        rows.append([asset, xs.shape[0], copy_seconds, view_seconds, copy_bytes, view_bytes])
+    print_report(rows, ['asset', 'n_row', 'copy_seconds', 'view_seconds', 'copy_bytes', 'view_bytes'])
+    return rows
+
+
+###############
+# Panel
+###############
+# Features and labels of every target asset: per asset data frames against one aligned panel
+def benchmark_panel(label_index=-1):
+    def load_assets():
+        return [get_classification_data(load_data(asset), label_index) for asset in target_assets]
+
+    def load_assets_panel():
+        panel = load_panel(target_assets)
+        return [panel.get_table(asset) for asset in target_assets]
+
+    # Data frames and tables give the same labels of every label column
+    panel = load_panel(target_assets)
+    for asset in target_assets:
+        for index in range(-n_label, 0):
+            assert np.array_equal(get_classification_data(load_data(asset), index)[1],
+                                  get_classification_data(panel.get_table(asset), index)[1])
+
+    rows = []
+    for name, func in [('data_frames', load_assets), ('panel', lambda: load_panel(target_assets)),
+                       ('panel_tables', load_assets_panel)]:
+        seconds, peak = measure(func)
+        rows.append([name, len(target_assets), seconds, peak])
+    print_report(rows, ['loader', 'n_asset', 'seconds', 'peak_bytes'])
+    return rows
+
+
+###############
+# Metrics
+###############
+# Metrics of n_config score rows at n_threshold thresholds: sklearn per configuration against one batched pass
+def benchmark_metrics(n_row=200, n_config=28, n_threshold=9, seed=0):
+    from sklearn.metrics import roc_auc_score, accuracy_score, f1_score, precision_score, recall_score
+    from app.metric import evaluate_thresholds, get_auc
+    rng = np.random.RandomState(seed)
+    gts = rng.randint(0, 2, n_row)
+    scores = rng.rand(n_config, n_row)
+    thresholds = np.arange(1, n_threshold + 1) / (n_threshold + 1.0)
+
+    def evaluate_sklearn():
+        for row in scores:
+            roc_auc_score(gts, row)
+            for threshold in thresholds:
+                predictions = (row > threshold).astype(int)
+                for metric in [accuracy_score, f1_score, precision_score, recall_score]:
+                    metric(gts, predictions)
+
+    def evaluate_batch():
+        get_auc(gts, scores)
+        evaluate_thresholds(gts, scores, thresholds)
+
+    rows = []
+    for name, func in [('sklearn', evaluate_sklearn), ('batch', evaluate_batch)]:
+        seconds, peak = measure(func, repeat=3)
+        rows.append([name, n_config * n_threshold, seconds, peak])
+    print_report(rows, ['evaluation', 'n_config', 'seconds', 'peak_bytes'])
+    return rows
+
+
+###############
+# Inference
+###############
+# Predictions per second of synthetic selections: a model load and predict per selection against the
+# inference engine, loaded once and batched per backend
+def benchmark_inference(n_asset=4, n_row=600, model_names=('gbdt', 'lr')):
+    from app.entry import predict_selection
+    from app.inference import InferenceEngine
+    from app.pipeline import run_predictions
+    from app.simulation import classification
+    import app.entry
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp()
+    rows = []
+    try:
+        os.chdir(work_dir)
+        for directory in ['data', 'output/model', 'output/report']:
+            os.makedirs(directory)
+        selections = []
+        for i in range(n_asset):
+            asset = 'synthetic{}'.format(i)
+            d = get_synthetic_data(n_row, seed=i)
+            d.to_csv('data/{}.csv'.format(asset))
+            for label_index in [-1, -3]:
+                best_performance = classification(asset, load_data(asset), 100, model_names=list(model_names),
+                                                  label_index=label_index, is_production=True)
+                selections.append(best_performance)
+        selections = pd.DataFrame(selections)
+        n_prediction = len(selections)
+        # Predictions are scored without writing the journals
+        save_prediction_result, app.entry.save_prediction_result = app.entry.save_prediction_result, \
+            lambda *args: None
+        try:
+            seconds = measure(lambda: [predict_selection(s) for _, s in selections.iterrows()], repeat=3,
+                              trace_memory=False)[0]
+            rows.append(['per_selection', n_prediction, seconds, n_prediction / seconds])
+            for ensemble in [False, True]:
+                seconds = measure(lambda: InferenceEngine(selections, ensemble).predict(), repeat=3,
+                                  trace_memory=False)[0]
+                rows.append(['engine_load_predict' + ('_ensemble' if ensemble else ''), n_prediction, seconds,
+                             n_prediction / seconds])
+                engine = InferenceEngine(selections, ensemble)
+                rate = engine.measure_throughput()
+                rows.append(['engine_predict' + ('_ensemble' if ensemble else ''), n_prediction, n_prediction / rate,
+                             rate])
+                seconds = measure(lambda: run_predictions(selections, ensemble), repeat=3, trace_memory=False)[0]
+                rows.append(['pipeline' + ('_ensemble' if ensemble else ''), n_prediction, seconds,
+                             n_prediction / seconds])
+        finally:
+            app.entry.save_prediction_result = save_prediction_result
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+    print_report(rows, ['inference', 'n_prediction', 'seconds', 'predictions_per_second'])
+    return rows
+
+
+###############
+# Compiled predictors
+###############
+# Import, load and predict seconds of lr and xgboost models against their compiled numpy predictors, predicting
+# one row and n_batch rows, with the largest score difference
+def benchmark_compiled(n_row=1500, n_batch=1000, repeat=20):
+    from app.compiled import load_compiled, get_compiled_file_path
+    d = get_synthetic_data(n_row)
+    xs, ys, feature_names, _ = get_classification_data(d)
+    batch_xs = np.concatenate([xs] * int(np.ceil(n_batch / float(len(xs)))))[:n_batch]
+    backend_modules = {'gbdt': 'xgboost', 'lr': 'sklearn.linear_model'}
+    work_dir = tempfile.mkdtemp()
+    rows = []
+    try:
+        for model_name in ['gbdt', 'lr']:
+            model = get_model(model_name, 'classification', feature_names=feature_names)
+            model.train(xs, ys)
+            model_path = os.path.join(work_dir, model_name)
+            model.save_model(model_path)
+            if not os.path.exists(get_compiled_file_path(model_path)):
+                print('{} not compiled'.format(model_name))
+                continue
+
+            def load_model():
+                loaded = get_model(model_name, 'classification', feature_names=feature_names)
+                loaded.load_model(model_path)
+                return loaded
+            loaded, compiled = load_model(), load_compiled(get_compiled_file_path(model_path))
+            difference = np.abs(loaded.predict(batch_xs)[0] - compiled.predict(batch_xs)).max()
+            for path, module, load, predict in [
+                    ('model', backend_modules[model_name], load_model, lambda x: loaded.predict(x)),
+                    ('compiled', 'app.compiled', lambda: load_compiled(get_compiled_file_path(model_path)),
+                     compiled.predict)]:
+                import_seconds = measure_import(module)[0]
+                load_seconds = measure(load, repeat=repeat, trace_memory=False)[0]
+                row_seconds = measure(predict, (xs[-1:],), repeat=repeat, trace_memory=False)[0]
+                batch_seconds = measure(predict, (batch_xs,), repeat=repeat, trace_memory=False)[0]
+                rows.append([model_name, path, import_seconds, load_seconds, row_seconds, batch_seconds, difference])
+    finally:
+        shutil.rmtree(work_dir)
+    print_report(rows, ['model_name', 'predictor', 'import_seconds', 'load_seconds', 'row_seconds', 'batch_seconds',
+                        'max_score_difference'])
+    return rows
+
+
+###############
+# Dtypes
+###############
+# Result and peak traced bytes of func() (None without tracemalloc)
+def trace(func):
+    tracemalloc = get_tracemalloc()
+    if tracemalloc is None:
+        return func(), None
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def get_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+
+# Memory of every stage from load to model input per dtype policy: bytes kept by the stage's result and peak
+# bytes allocated by it (the xgboost input copy included, its own matrix not). Then the accuracy parity of the
+# dtype policies against float64 on the bundled assets. Returns the assets and models whose auc or accuracy
+# differ from float64 by more than tolerance.
+def benchmark_dtype(model_names=('gbdt', 'lr'), test_size=200, batch_size=128, rnn_length=20, tolerance=0.02):
+    import xgboost as xgb
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import StandardScaler
+    from app.data import load_table, dtype_policies
+
+    rows = []
+    for asset, policy in product(target_assets, sorted(dtype_policies)):
+        # The first load converts the store of the dtype
+        load_table(asset, dtype_policy=policy)
+        table, peak = trace(lambda: load_table(asset, dtype_policy=policy))
+        rows.append([asset, policy, 'table', get_nbytes(table.values), peak])
+        (xs, ys, feature_names, _), peak = trace(lambda: get_classification_data(table, -1, policy))
+        rows.append([asset, policy, 'features', get_nbytes(xs), peak])
+        rows.append([asset, policy, 'labels', get_nbytes(ys), peak])
+        _, peak = trace(lambda: xgb.DMatrix(xs, label=ys))
+        rows.append([asset, policy, 'dmatrix', '-', peak])
+        norm_xs, peak = trace(lambda: StandardScaler().fit(xs).transform(xs).astype(xs.dtype, copy=False))
+        rows.append([asset, policy, 'scaled', get_nbytes(norm_xs), peak])
+        batch, peak = trace(lambda: np.array(get_rnn_data(norm_xs, ys, rnn_length)[0][:batch_size]))
+        rows.append([asset, policy, 'rnn_batch', get_nbytes(batch), peak])
+    print_report(rows, ['asset', 'dtype_policy', 'stage', 'bytes', 'peak_bytes'])
+
+    rows, mismatches = [], []
+    for asset in target_assets:
+        performances = {}
+        for policy in sorted(dtype_policies):
+            xs, ys, feature_names, _ = get_classification_data(load_table(asset, dtype_policy=policy), -1, policy)
+            train_xs, test_xs, train_ys, test_ys = train_test_split(xs, ys, shuffle=False, test_size=test_size)
+            for model_name in model_names:
+                model = get_model(model_name, 'classification', feature_names=feature_names)
+                model.train(train_xs, train_ys)
+                scores, predictions = model.predict(test_xs)
+                performances[model_name, policy] = model.evaluate(model.get_test_labels(test_ys), predictions, scores)
+        for model_name, policy in product(model_names, sorted(dtype_policies)):
+            performance, base = performances[model_name, policy], performances[model_name, 'float64']
+            auc_delta = performance['auc'] - base['auc']
+            accuracy_delta = performance['accuracy'] - base['accuracy']
+            if abs(auc_delta) > tolerance or abs(accuracy_delta) > tolerance:
+                mismatches.append('{}/{}/{}'.format(asset, model_name, policy))
+            rows.append([asset, model_name, policy, performance['auc'], performance['accuracy'], auc_delta,
+                         accuracy_delta])
+    print_report(rows, ['asset', 'model_name', 'dtype_policy', 'auc', 'accuracy', 'auc_delta', 'accuracy_delta'])
+    if mismatches:
+        print('dtype parity over {}: {}'.format(tolerance, mismatches))
+    return mismatches
+
+
+###############
+# Startup
+###############
+entry_points = {'predict': 'app.entry', 'serve': 'app.server', 'simulate': 'app.simulation'}
+backends = ['keras', 'tensorflow', 'xgboost', 'sklearn', 'matplotlib']
+
+
+# Import time of a module in a fresh interpreter and the backends it loads
+def measure_import(module, repeat=3):
+    code = 'import sys, time; start = time.time(); import {}; print(time.time() - start); ' \
+           'print(",".join(m for m in {} if m in sys.modules))'.format(module, backends)
+    seconds = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', code], stderr=devnull)
+            lines = output.decode('utf-8').splitlines()
+            seconds.append(float(lines[-2]))
+    return min(seconds), lines[-1]
+
+
+def benchmark_startup():
+    rows = []
+    for name, module in sorted(entry_points.items()):
+        seconds, loaded = measure_import(module)
+        rows.append([name, module, seconds, loaded or '-'])
+    for module in backends:
+        seconds, loaded = measure_import(module)
+        rows.append(['backend', module, seconds, loaded])
+    print_report(rows, ['entry_point', 'module', 'import_seconds', 'backends'])
+    return rows
+
+
+###############
+# Timing
+###############
+# Per call overhead of span and timed when instrumentation is disabled and when it only keeps totals
+def benchmark_timing(n_call=100000):
+    from app import timing
+
+    def call():
+        pass
+
+    def call_span():
+        with timing.span('benchmark'):
+            pass
+
+    rows = []
+    for name, func in [('call', call), ('span', call_span), ('timed', timing.timed('benchmark')(call))]:
+        for enabled in [False, True]:
+            timing.enabled = enabled
+            seconds = measure(lambda: [func() for _ in range(n_call)], repeat=3, trace_memory=False)[0]
+            rows.append([name, enabled, seconds / n_call * 1e6])
+    timing.disable()
+    timing.totals.clear()
+    print_report(rows, ['function', 'enabled', 'microseconds_per_call'])
+    return rows
+
+
+###############
+# Suite
+###############
+# Synthetic asset shaped like data/*.csv: dated rows of n_feature features and n_label labels
+def get_synthetic_data(n_row=1500, n_feature=25, seed=0):
+    rng = np.random.RandomState(seed)
+    dates = pd.bdate_range('2013-07-19', periods=n_row).strftime('%b %d, %Y')
+    xs = rng.randn(n_row, n_feature)
+    # Labels depend on the features with noise
+    ys = xs[:, :n_label] * 0.5 + rng.randn(n_row, n_label)
+    columns = ['feature{}'.format(i + 1) for i in range(n_feature)] + ['label{}'.format(i + 1) for i in range(n_label)]
+    return pd.DataFrame(np.hstack([xs, ys]), index=pd.Index(dates, name='Date'), columns=columns)
+
+
+# Timed hot paths on a synthetic asset of n_row rows: (name, function, repeat).
+# Functions run in order, so model cases use the models trained by earlier cases.
+def get_suite_cases(n_row=1500, test_size=200):
+    import xgboost as xgb
+    from app.simulation import classification, walk_forward
+
+    asset = 'synthetic'
+    d = get_synthetic_data(n_row)
+    d.to_csv('data/{}.csv'.format(asset))
+    xs, ys, feature_names, _ = get_classification_data(d)
+    feature_names = list(feature_names)
+    train_xs, train_ys, test_xs = xs[:-test_size], ys[:-test_size], xs[-test_size:]
+    d_train = xgb.DMatrix(train_xs, label=train_ys, feature_names=feature_names)
+    d_all = xgb.DMatrix(xs, label=ys, feature_names=feature_names)
+    models = {}
+
+    def train(model_name):
+        models[model_name] = get_model(model_name, 'classification', feature_names=feature_names)
+        models[model_name].train(train_xs, train_ys)
+
+    cases = [
+        ('build_store', lambda: build_store(asset), 3),
+        ('load_data', lambda: load_data(asset), 5),
+        ('get_classification_data', lambda: get_classification_data(d), 5),
+        ('get_rnn_data', lambda: get_rnn_data(xs, ys), 5),
+        ('xgb_param_selection', lambda: xgb_param_selection(get_xgb_classification_params(), d_train), 1),
+    ]
+    for model_name in ['gbdt', 'lr', 'rnn']:
+        cases += [
+            ('{}_train'.format(model_name), lambda m=model_name: train(m), 1),
+            ('{}_predict'.format(model_name), lambda m=model_name: models[m].predict(test_xs), 5),
+            ('{}_search_threshold'.format(model_name),
+             lambda m=model_name: search_threshold(train_xs, train_ys, models[m], test_size), 5),
+        ]
+    cases += [
+        ('classification', lambda: classification(asset, d, test_size, model_names=['gbdt', 'lr']), 1),
+        ('sequential_batch', lambda: walk_forward(d_all, n_row - test_size, 20, 20, [0.997], incremental=False), 1),
+    ]
+    return cases
+
+
+# Run the suite in a scratch directory, append the results to the history and compare with the baseline.
+# Returns the cases slower than the baseline by more than tolerance.
+def benchmark_suite(n_row=1500, case_names=None, save_baseline=False, tolerance=0.2):
+    history_path, baseline_path = get_benchmark_history_file_path(), get_benchmark_baseline_file_path()
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        os.chdir(work_dir)
+        for directory in ['data', 'output/exp']:
+            os.makedirs(directory)
+        for name, func, repeat in get_suite_cases(n_row):
+            if case_names and name not in case_names:
+                continue
+            try:
+                seconds, error = measure(func, repeat=repeat, trace_memory=False)[0], None
+            except Exception as e:
+                seconds, error = None, repr(e)
+            results.append({'case': name, 'n_row': n_row, 'seconds': seconds, 'error': error})
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    rows, regressions = [], []
+    for result in results:
+        base = baseline.get('{}/{}'.format(result['case'], n_row))
+        ratio = result['seconds'] / base if base and result['seconds'] is not None else None
+        is_regression = ratio is not None and ratio > 1 + tolerance
+        if is_regression:
+            regressions.append(result['case'])
+        result.update({'baseline_seconds': base, 'ratio': ratio, 'is_regression': is_regression})
+        rows.append([result['case'], result['seconds'], base, ratio, is_regression, result['error'] or '-'])
+    print_report(rows, ['case', 'seconds', 'baseline_seconds', 'ratio', 'is_regression', 'error'])
+
+    if not os.path.exists(os.path.dirname(history_path)):
+        os.makedirs(os.path.dirname(history_path))
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'versions': get_versions(), 'results': results}
+    with open(history_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    if save_baseline:
+        baseline.update(('{}/{}'.format(r['case'], n_row), r['seconds']) for r in results if r['seconds'] is not None)
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    if regressions:
+        print('regressions over {:.0%}: {}'.format(tolerance, regressions))
+    return regressions
+
+
+def get_versions():
+    versions = {'python': sys.version.split()[0]}
+    for module in ['numpy', 'pandas', 'sklearn', 'xgboost', 'keras', 'tensorflow']:
+        if module in sys.modules:
+            versions[module] = getattr(sys.modules[module], '__version__', None)
+    return versions
+
+
+def get_benchmark_history_file_path():
+    return os.path.abspath(os.path.join('output/benchmark', 'history.jsonl'))
+
+
+def get_benchmark_baseline_file_path():
+    return os.path.abspath(os.path.join('output/benchmark', 'baseline.json'))
+
+
+benchmarks = {
+    'compiled': benchmark_compiled,
+    'dtype': benchmark_dtype,
+    'inference': benchmark_inference,
+    'metrics': benchmark_metrics,
+    'panel': benchmark_panel,
+    'rnn_data': benchmark_rnn_data,
+    'startup': benchmark_startup,
+    'suite': benchmark_suite,
+    'timing': benchmark_timing,
+}
+
+
+# python -m app.benchmark [name ...] [--rows N] [--cases case ...] [--save-baseline] [--tolerance 0.2]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help=', '.join(sorted(benchmarks)))
+    parser.add_argument('--rows', type=int, default=1500)
+    parser.add_argument('--cases', nargs='*')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    if set(args.names) - set(benchmarks):
+        parser.error('unknown benchmarks: {}'.format(sorted(set(args.names) - set(benchmarks))))
+    regressions = []
+    for name in args.names or sorted(benchmarks):
+        print('# {}'.format(name))
+        if name == 'suite':
+            regressions += benchmark_suite(args.rows, args.cases, args.save_baseline, args.tolerance)
+        elif name == 'dtype':
+            regressions += benchmark_dtype()
+        else:
+            benchmarks[name]()
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from app.constant import dmatrix_cache_size, artifact_cache_bytes
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        # Reinserted as the most recently used
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.items.clear()
+
+
+def get_fingerprint(*arrays):
+    sha1 = hashlib.sha1()
+    for array in arrays:
+        if array is None:
+            sha1.update(b'none')
+            continue
+        array = np.ascontiguousarray(array)
+        sha1.update('{}{}'.format(array.dtype, array.shape).encode('utf-8'))
+        sha1.update(array.data)
+    return sha1.hexdigest()
+
+
+###############
+# XGBoost
+###############
+# DMatrix by data fingerprint, shared by parameter search, training, threshold search and PR curves
+dmatrices = LRUCache(dmatrix_cache_size)
+# cv folds of a DMatrix, by DMatrix and its labels and weights: [(fold train DMatrix, fold test DMatrix)]
+cv_folds = LRUCache(dmatrix_cache_size)
+
+
+def get_dmatrix(xs, ys=None, feature_names=None, weights=None):
+    import xgboost as xgb
+    feature_names = list(feature_names) if feature_names is not None else None
+    key = (get_fingerprint(xs, ys, weights), tuple(feature_names or ()))
+    d_matrix = dmatrices.get(key)
+    if d_matrix is None:
+        d_matrix = dmatrices.put(key, xgb.DMatrix(xs, label=ys, weight=weights, feature_names=feature_names))
+    return d_matrix
+
+
+# Same folds as xgb.cv with its default seed
+def get_cv_folds(d_matrix, nfold=5, seed=0):
+    key = (id(d_matrix), nfold, seed, get_fingerprint(d_matrix.get_label(), d_matrix.get_weight()))
+    entry = cv_folds.get(key)
+    if entry is not None and entry[0] is d_matrix:
+        return entry[1]
+    folds = []
+    for train_index, test_index in get_cv_fold_indices(d_matrix.num_row(), nfold, seed):
+        folds.append((d_matrix.slice(train_index), d_matrix.slice(test_index)))
+    # The DMatrix is kept with its folds so its id is not reused while cached
+    cv_folds.put(key, (d_matrix, folds))
+    return folds
+
+
+def get_cv_fold_indices(n_row, nfold=5, seed=0):
+    np.random.seed(seed)
+    test_indices = np.array_split(np.random.permutation(n_row), nfold)
+    return [(np.concatenate([test_indices[j] for j in range(nfold) if j != k]), test_indices[k])
+            for k in range(nfold)]
+
+
+###############
+# Artifacts
+###############
+# Trained models by content: output/model/artifact/{key}/ holds the saved model and meta.json (status, threshold
+# search and feature importance). The key hashes the training data, the model name and config, the library
+# versions and extra inputs such as the validation size. Artifacts beyond max_bytes are evicted least recently
+# used first; the models of the selections in output/model are never evicted.
+def get_artifact_key(model, train_xs, train_ys, *args):
+    sha1 = hashlib.sha1()
+    for part in [get_fingerprint(np.asarray(train_xs), np.asarray(train_ys)), model.name,
+                 json.dumps(model.get_config(), sort_keys=True, default=str),
+                 json.dumps(get_library_versions(), sort_keys=True), repr(args)]:
+        sha1.update(part.encode('utf-8'))
+    return sha1.hexdigest()
+
+
+# Read once from the installed distributions, so the key does not depend on which modules were imported first.
+# pkg_resources is slow to import and only imported for artifact keys.
+library_versions = {}
+
+
+def get_library_versions():
+    if library_versions:
+        return library_versions
+    import pkg_resources
+    versions = {'python': sys.version.split()[0]}
+    for distribution in ['numpy', 'scikit-learn', 'xgboost', 'Keras', 'tensorflow']:
+        try:
+            versions[distribution] = pkg_resources.get_distribution(distribution).version
+        except pkg_resources.DistributionNotFound:
+            versions[distribution] = None
+    library_versions.update(versions)
+    return library_versions
+
+
+# Loads the artifact into model and returns its meta, or None
+def load_artifact(key, model):
+    directory = get_artifact_directory_path(key)
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    model.load_model(os.path.join(directory, 'model'))
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # Access time for eviction
+    os.utime(meta_path, None)
+    model.status = meta['status']
+    return meta
+
+
+# The artifact is written to a temporary directory and renamed into place
+def save_artifact(key, model, meta, max_bytes=artifact_cache_bytes):
+    directory = get_artifact_directory_path(key)
+    root = os.path.dirname(directory)
+    if not os.path.exists(root):
+        os.makedirs(root)
+    tmp_directory = tempfile.mkdtemp(prefix='.tmp', dir=root)
+    model.save_model(os.path.join(tmp_directory, 'model'))
+    with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default=float)
+    if os.path.exists(directory):
+        shutil.rmtree(tmp_directory)
+    else:
+        os.rename(tmp_directory, directory)
+    evict_artifacts(max_bytes, keep=key)
+
+
+def evict_artifacts(max_bytes=artifact_cache_bytes, keep=None):
+    root = get_artifact_directory_path('')
+    if not os.path.exists(root):
+        return
+    entries = []
+    for key in os.listdir(root):
+        meta_path = os.path.join(root, key, 'meta.json')
+        # Artifacts being written
+        if key.startswith('.') or not os.path.exists(meta_path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(os.path.join(root, key))
+                   for name in names)
+        entries.append((os.path.getmtime(meta_path), key, size))
+    total = sum(entry[2] for entry in entries)
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(root, key), ignore_errors=True)
+        total -= size
+
+
+def get_artifact_directory_path(key):
+    return os.path.join('output/model/artifact', key)
@@ -0,0 +1,147 @@
+import os
+import re
+
+import numpy as np
+
+# Predictors compiled from trained models into numpy arrays, saved next to the model as {model_path}.npz. They
+# score without sklearn or xgboost and load with one np.load.
+
+split_pattern = re.compile(r'^(\d+):\[(.+)<([^<\]]+)\] yes=(\d+),no=(\d+),missing=(\d+)')
+leaf_pattern = re.compile(r'^(\d+):leaf=(\S+)')
+# Largest difference of compiled and booster margins, relative to the largest margin: float32 sums of the trees
+margin_tolerance = 1e-5
+
+
+###############
+# Predictors
+###############
+# Logistic regression: sigmoid of the features times the coefficients plus the intercept
+class CompiledLR(object):
+    kind = 'lr'
+
+    def __init__(self, coef, intercept):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = np.float64(intercept)
+
+    def predict(self, xs):
+        logits = np.dot(np.asarray(xs, dtype=np.float64), self.coef) + self.intercept
+        return 1 / (1 + np.exp(-logits))
+
+    def get_arrays(self):
+        return {'coef': self.coef, 'intercept': self.intercept}
+
+
+# Boosted trees of a binary:logistic booster as flat node arrays: feature index (-1 at leaves), float32 split
+# value, yes/no/missing children and leaf value. Every row descends all trees at once, one level per step;
+# leaf values are added in tree order in float32 as xgboost does.
+class CompiledTrees(object):
+    kind = 'trees'
+
+    def __init__(self, feature, threshold, yes, no, missing, value, roots, depth, base_margin=0.0):
+        self.feature, self.threshold = np.asarray(feature, dtype=np.int32), np.asarray(threshold, dtype=np.float32)
+        self.yes, self.no = np.asarray(yes, dtype=np.int32), np.asarray(no, dtype=np.int32)
+        self.missing = np.asarray(missing, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float32)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.depth = int(depth)
+        self.base_margin = np.float32(base_margin)
+
+    def get_margin(self, xs):
+        xs = np.atleast_2d(np.asarray(xs, dtype=np.float32))
+        # A booster of 0 rounds: the base margin only
+        if not len(self.roots):
+            return np.full(len(xs), self.base_margin, dtype=np.float32)
+        rows = np.arange(len(xs))[:, np.newaxis]
+        nodes = np.repeat(self.roots[np.newaxis], len(xs), axis=0)
+        for _ in range(self.depth):
+            feature = self.feature[nodes]
+            values = xs[rows, np.maximum(feature, 0)]
+            children = np.where(np.isnan(values), self.missing[nodes],
+                                np.where(values < self.threshold[nodes], self.yes[nodes], self.no[nodes]))
+            nodes = np.where(feature < 0, nodes, children)
+        leaves = self.value[nodes]
+        return self.base_margin + np.cumsum(leaves, axis=1, dtype=np.float32)[:, -1]
+
+    def predict(self, xs):
+        margins = self.get_margin(xs)
+        return np.float32(1) / (np.float32(1) + np.exp(-margins))
+
+    def get_arrays(self):
+        return {'feature': self.feature, 'threshold': self.threshold, 'yes': self.yes, 'no': self.no,
+                'missing': self.missing, 'value': self.value, 'roots': self.roots, 'depth': self.depth,
+                'base_margin': self.base_margin}
+
+
+predictors = {
+    'lr': CompiledLR,
+    'trees': CompiledTrees,
+}
+
+
+###############
+# Compilation
+###############
+# Trees of a text model dump (Booster.get_dump()). Splits name a feature of feature_names or f{index}.
+def compile_trees(dump, feature_names, base_margin=0.0):
+    feature_indices = dict((name, i) for i, name in enumerate(feature_names))
+    feature, threshold, yes, no, missing, value, roots = [], [], [], [], [], [], []
+    depth = 0
+    for tree in dump:
+        nodes = {}
+        for line in tree.split('\n'):
+            line = line.strip()
+            if line:
+                nodes[int(line.split(':', 1)[0])] = line
+        # Pruned node ids are missing from the dump: nodes are renumbered in id order
+        positions = dict((node_id, len(feature) + i) for i, node_id in enumerate(sorted(nodes)))
+        node_depths = {0: 0}
+        for node_id in sorted(nodes):
+            split = split_pattern.match(nodes[node_id])
+            if split:
+                name = split.group(2)
+                index = feature_indices[name] if name in feature_indices else int(name[1:])
+                children = [int(split.group(i)) for i in [4, 5, 6]]
+                feature.append(index)
+                threshold.append(np.float32(split.group(3)))
+                yes.append(positions[children[0]])
+                no.append(positions[children[1]])
+                missing.append(positions[children[2]])
+                value.append(0.0)
+                for child in children[:2]:
+                    node_depths[child] = node_depths[node_id] + 1
+            else:
+                leaf = leaf_pattern.match(nodes[node_id])
+                if leaf is None:
+                    raise ValueError('unknown node in model dump: {}'.format(nodes[node_id]))
+                feature.append(-1)
+                threshold.append(0.0)
+                yes.append(positions[node_id])
+                no.append(positions[node_id])
+                missing.append(positions[node_id])
+                value.append(np.float32(leaf.group(2)))
+                depth = max(depth, node_depths[node_id])
+        roots.append(positions[0])
+    return CompiledTrees(feature, threshold, yes, no, missing, value, roots, depth, base_margin)
+
+
+###############
+# IO
+###############
+# None removes the predictor of a previous model, so inference falls back to the backend
+def save_compiled(file_path, predictor):
+    if predictor is None:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+    with open(file_path, 'wb') as f:
+        np.savez(f, kind=predictor.kind, **predictor.get_arrays())
+
+
+def load_compiled(file_path):
+    with np.load(file_path) as arrays:
+        kwargs = dict((name, arrays[name]) for name in arrays.files if name != 'kind')
+        return predictors[str(arrays['kind'])](**kwargs)
+
+
+def get_compiled_file_path(model_path):
+    return model_path + '.npz'
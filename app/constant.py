@@ -3,3 +3,46 @@ label_indices = [-1, -3]
 # label_indices = [-1]
 target_assets = ['HSI', 'CAC40', 'DAX', 'S&P500', 'S&P_TSX']
 # target_assets = ['HSI']
+# xgboost parameter search: worker processes (1: serial xgb.cv) and xgboost threads per worker
+n_search_workers = 1
+n_search_threads = 1
+# model training: target worker processes (1: serial) and tensorflow/xgboost threads per worker (None: the cores
+# shared between the workers)
+n_train_workers = 1
+n_train_threads = None
+# prediction server: bytes of model files kept loaded
+model_cache_bytes = 512 * 1024 * 1024
+# instrumentation: span trace file (None: disabled, e.g. 'output/trace/trace.jsonl'), stages to profile
+# (e.g. ['train']) and profiler ('cprofile' or 'pyinstrument')
+trace_path = None
+profile_stages = []
+profiler = 'cprofile'
+# xgboost DMatrix and cv fold cache: entries kept
+dmatrix_cache_size = 16
+# hyperparameter search of get_model (None: xgboost grid, lr and rnn defaults; 'halving', 'hyperband' or 'tpe')
+# and its wall-clock budget in seconds per model
+model_search = None
+model_search_seconds = None
+# feature store: newest rows per asset kept in memory for predictions and ingestion
+tail_rows = 250
+# trained model artifacts by content (output/model/artifact): disk budget in bytes (0: no artifact cache)
+artifact_cache_bytes = 2 * 1024 * 1024 * 1024
+# report csv files and PR curves: background writer threads (0: written inline) and queued writes
+n_report_workers = 2
+max_pending_reports = 64
+# model training: train the labels of an asset together (shared data and one multi-output rnn)
+multi_label_training = False
+# data and model input dtypes: 'float64' or 'float32' (float32 features and int8 labels)
+dtype_policy = 'float64'
+# simulation sweeps: cell worker processes (1: serial) and tensorflow/xgboost threads per worker process
+# (None: the cores shared between the workers; a serial sweep always uses all)
+n_sweep_workers = 1
+n_sweep_threads = None
+# daily predictions: concurrent pipeline of the selections (app.pipeline; False: one batched inference engine
+# pass), inference and file threads, and the seconds after which unfinished selections are no longer waited for
+async_prediction = False
+n_prediction_workers = 4
+n_io_workers = 4
+prediction_timeout = 300
+# inference: score lr and xgboost models with their compiled numpy predictors ({model_path}.npz) when saved
+compiled_inference = True
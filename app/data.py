@@ -1,28 +1,371 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+from collections import namedtuple
+
+import numpy as np
 import pandas as pd
-from app.constant import n_label
+from app.constant import n_label, target_assets, tail_rows, dtype_policy
+from app.timing import span
+
+# Feature and label dtypes of a dtype policy, from load to model input. Labels of float64 are lists of int.
+dtype_policies = {
+    'float64': (np.float64, None),
+    'float32': (np.float32, np.int8),
+}
+
+
+# Rows of one asset: values (n_row x n_column float array), column names and dates
+class Table(namedtuple('Table', ['values', 'columns', 'index'])):
+    @property
+    def shape(self):
+        return self.values.shape
 
 
 # column: 1: date, ~: features, last 4: labels
-def load_data(asset='hsi3', is_prediction=False):
-    file_path = 'data/{}.csv'.format(asset)
-    d = pd.read_csv(file_path, index_col=0)
-    # Remove empty features or labels
-    if is_prediction:
-        d = d[d.iloc[:, :-n_label].notnull().all(axis=1)]
-    else:
-        d = d[d.notnull().all(axis=1)]
-    return d
+def load_data(asset='hsi3', is_prediction=False, dtype_policy=dtype_policy):
+    table = load_table(asset, is_prediction, dtype_policy)
+    return pd.DataFrame(table.values, index=table.index, columns=table.columns)
+
 
+def load_table(asset='hsi3', is_prediction=False, dtype_policy=dtype_policy):
+    with span('load_data', asset=asset):
+        values, schema = load_store(asset, get_dtypes(dtype_policy)[0])
+        # Remove empty features or labels
+        if is_prediction:
+            valid = ~np.isnan(values[:, :-n_label]).any(axis=1)
+        else:
+            valid = ~np.isnan(values).any(axis=1)
+        index = pd.Index(schema['index'], name=schema['index_name'])
+        columns = pd.Index(schema['columns'])
+        if valid.all():
+            return Table(values, columns, index)
+        return Table(values[valid], columns, index[valid])
 
-def get_classification_data(d, label_index=-1):
+
+def get_classification_data(d, label_index=-1, dtype_policy=dtype_policy):
+    feature_dtype = get_dtypes(dtype_policy)[0]
     feature_index = d.shape[1] - n_label
     feature_names = d.columns[:feature_index]
-    xs = d.iloc[:, :feature_index].values
     label_column = d.columns[label_index]
-    ys = list((d.iloc[:, label_index] > 0).astype(int))
+    if isinstance(d, Table):
+        values, label_values = d.values, d.values[:, label_index]
+    else:
+        # The features and the label column only: the label is the last column
+        values = d.iloc[:, list(range(feature_index)) + [label_index]].values
+        label_values = values[:, -1]
+    xs = values[:, :feature_index].astype(feature_dtype, copy=False)
+    ys = get_labels(label_values, dtype_policy)
     return xs, ys, feature_names, label_column
 
 
+# Binary labels (value > 0) of label values, n or n x n_label, in the label dtype of the policy
+def get_labels(values, dtype_policy=dtype_policy):
+    label_dtype = get_dtypes(dtype_policy)[1]
+    ys = np.asarray(values) > 0
+    if label_dtype is None:
+        return list(ys.astype(int)) if ys.ndim == 1 else ys.astype(int)
+    return ys.astype(label_dtype)
+
+
+def get_dtypes(dtype_policy=dtype_policy):
+    if dtype_policy not in dtype_policies:
+        raise ValueError('unknown dtype policy {}, expected one of {}'.format(dtype_policy, sorted(dtype_policies)))
+    return dtype_policies[dtype_policy]
+
+
+###############
+# Panel
+###############
+date_format = '%b %d, %Y'
+
+
+# All assets aligned on the union of their trading dates, dates parsed once.
+# values: n_asset x n_date x n_column, NaN where an asset has no row; mask: dates with features and labels,
+# feature_mask: dates with features; dates: sorted datetime64[D]; columns: names per asset, the assets share
+# the column layout; index: n_asset x n_date date strings of the csv files, None where an asset has no row
+class Panel(namedtuple('Panel', ['values', 'mask', 'feature_mask', 'dates', 'assets', 'columns', 'index'])):
+    @property
+    def features(self):
+        return self.values[:, :, :-n_label]
+
+    @property
+    def labels(self):
+        return self.values[:, :, -n_label:]
+
+    # Dates in [start, end] (date strings, datetimes or None) are views, a subset of assets is a copy
+    def slice(self, assets=None, start=None, end=None):
+        i = 0 if start is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start), 'D'))
+        j = len(self.dates) if end is None else \
+            np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end), 'D'), side='right')
+        if assets is None:
+            return Panel(self.values[:, i:j], self.mask[:, i:j], self.feature_mask[:, i:j], self.dates[i:j],
+                         self.assets, self.columns, self.index[:, i:j])
+        rows = [self.assets.index(asset) for asset in assets]
+        return Panel(self.values[rows, i:j], self.mask[rows, i:j], self.feature_mask[rows, i:j], self.dates[i:j],
+                     list(assets), [self.columns[a] for a in rows], self.index[rows, i:j])
+
+    # Valid rows of one asset, as load_table returns them
+    def get_table(self, asset, is_prediction=False):
+        a = self.assets.index(asset)
+        valid = self.feature_mask[a] if is_prediction else self.mask[a]
+        return Table(self.values[a, valid], pd.Index(self.columns[a]), pd.Index(self.index[a, valid], name='Date'))
+
+
+def load_panel(assets=None, dtype=np.float32):
+    assets = list(assets or target_assets)
+    with span('load_panel'):
+        stores = [load_store(asset) for asset in assets]
+        if len(set(store.shape[1] for store, _ in stores)) > 1:
+            raise ValueError('assets have different numbers of columns: {}'.format(
+                dict((asset, store.shape[1]) for asset, (store, _) in zip(assets, stores))))
+        asset_dates = [get_schema_dates(schema) for _, schema in stores]
+        dates = np.unique(np.concatenate(asset_dates))
+        values = np.full((len(assets), len(dates), stores[0][0].shape[1]), np.nan, dtype=dtype)
+        index = np.full((len(assets), len(dates)), None, dtype=object)
+        for a, ((store, schema), store_dates) in enumerate(zip(stores, asset_dates)):
+            positions = np.searchsorted(dates, store_dates)
+            values[a, positions] = store
+            index[a, positions] = schema['index']
+        feature_mask = ~np.isnan(values[:, :, :-n_label]).any(axis=2)
+        mask = feature_mask & ~np.isnan(values[:, :, -n_label:]).any(axis=2)
+        return Panel(values, mask, feature_mask, dates, assets, [schema['columns'] for _, schema in stores], index)
+
+
+# Dates of the store rows as datetime64[D], parsed when the store was built
+def get_schema_dates(schema):
+    if 'days' in schema:
+        return np.array(schema['days'], dtype='datetime64[D]')
+    return pd.to_datetime(schema['index'], format=date_format).values.astype('datetime64[D]')
+
+
+# Features (n_asset x n_date x n_feature view), binary labels (n_asset x n_date int8, 0 where missing) and mask
+def get_panel_classification_data(panel, label_index=-1):
+    labels = panel.values[:, :, label_index]
+    ys = (np.nan_to_num(labels) > 0).astype(np.int8)
+    return panel.features, ys, panel.mask
+
+
+###############
+# Feature store
+###############
+# data/{asset}.csv is parsed once into output/cache/{asset}.npy (memory mapped on load) and a schema
+# sidecar {asset}.json, rebuilt when the csv content changes. Other dtypes than float64 are converted once into
+# their own store, e.g. output/cache/{asset}.float32.npy, so loads stay memory mapped.
+def load_store(asset, dtype=np.float64):
+    file_path, store_path, schema_path = get_data_file_path(asset), get_store_file_path(asset), get_schema_file_path(asset)
+    schema = None
+    if os.path.exists(schema_path) and os.path.exists(store_path):
+        with open(schema_path) as f:
+            schema = json.load(f)
+        stat = os.stat(file_path)
+        if (schema['mtime'], schema['size']) != (stat.st_mtime, stat.st_size):
+            if schema['sha1'] == get_file_hash(file_path):
+                schema.update({'mtime': stat.st_mtime, 'size': stat.st_size})
+                save_schema(schema_path, schema)
+            else:
+                schema = None
+    if schema is None:
+        schema = build_store(asset)
+    values = np.load(store_path, mmap_mode='r')
+    if np.dtype(dtype) == values.dtype:
+        return values, schema
+    return load_dtype_store(store_path, get_store_file_path(asset, dtype), values, dtype), schema
+
+
+def load_dtype_store(store_path, dtype_store_path, values, dtype):
+    if os.path.exists(dtype_store_path) and os.stat(dtype_store_path).st_mtime >= os.stat(store_path).st_mtime:
+        dtype_values = np.load(dtype_store_path, mmap_mode='r')
+        if dtype_values.shape == values.shape:
+            return dtype_values
+    save_array(dtype_store_path, values.astype(dtype))
+    return np.load(dtype_store_path, mmap_mode='r')
+
+
+def build_store(asset):
+    file_path, store_path, schema_path = get_data_file_path(asset), get_store_file_path(asset), get_schema_file_path(asset)
+    stat = os.stat(file_path)
+    d = pd.read_csv(file_path, index_col=0)
+    if not os.path.exists(os.path.dirname(store_path)):
+        os.makedirs(os.path.dirname(store_path))
+    # Store before schema: the schema marks a complete store
+    save_array(store_path, d.values.astype(np.float64))
+    days = pd.to_datetime(d.index, format=date_format).values.astype('datetime64[D]').astype(np.int64)
+    schema = {'columns': list(d.columns), 'index': list(d.index), 'index_name': d.index.name, 'days': days.tolist(),
+              'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': get_file_hash(file_path)}
+    save_schema(schema_path, schema)
+    return schema
+
+
+def save_schema(file_path, schema):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(schema, f)
+    os.rename(tmp_path, file_path)
+
+
+# Written to a temporary file of this writer and renamed into place, so processes building the same store
+# never share a partial file
+def save_array(file_path, values):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, values)
+    os.rename(tmp_path, file_path)
+
+
+def get_file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+###############
+# Ingestion
+###############
+# New rows of an asset: start is the store position of the first row
+Change = namedtuple('Change', ['asset', 'start', 'table'])
+
+# Callables notified with every Change, e.g. to update scalers, DMatrix or windows incrementally
+listeners = []
+
+# Newest rows of each asset, valid or not: asset -> (csv mtime and size, store row count, Table)
+tails = {}
+
+
+def subscribe(listener):
+    listeners.append(listener)
+    return listener
+
+
+def unsubscribe(listener):
+    listeners.remove(listener)
+
+
+# Appends rows (a data frame with the store's columns, dated after the last stored row) to data/{asset}.csv,
+# the store and the tail, then notifies listeners. The csv is written first, so an interrupted ingestion
+# leaves a stale schema and the store is rebuilt from the csv.
+def ingest_rows(asset, d):
+    with span('ingest_rows', asset=asset):
+        values, schema = load_store(asset)
+        if list(d.columns) != schema['columns']:
+            raise ValueError('{} rows have columns {}, the store has {}'.format(asset, list(d.columns),
+                                                                            schema['columns']))
+        days = pd.to_datetime(d.index, format=date_format).values.astype('datetime64[D]')
+        stored_days = get_schema_dates(schema)
+        if len(days) and (days[0] <= stored_days[-1] or (np.diff(days) <= np.timedelta64(0, 'D')).any()):
+            raise ValueError('{} rows must be dated in order after {}'.format(asset, schema['index'][-1]))
+        new_values = d.values.astype(values.dtype)
+        start = values.shape[0]
+        del values
+
+        file_path = get_data_file_path(asset)
+        with open(file_path, 'a') as f:
+            d.to_csv(f, header=False)
+        append_store(get_store_file_path(asset), new_values)
+        for dtype_store_path in get_dtype_store_file_paths(asset):
+            append_store(dtype_store_path, new_values)
+        stat = os.stat(file_path)
+        schema.update({'index': schema['index'] + list(d.index),
+                       'days': np.concatenate([stored_days, days]).astype(np.int64).tolist(),
+                       'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': get_file_hash(file_path)})
+        save_schema(get_schema_file_path(asset), schema)
+
+        table = Table(new_values, pd.Index(schema['columns']), pd.Index(list(d.index), name=schema['index_name']))
+        if asset in tails:
+            tail = tails[asset][2]
+            n_keep = max(len(tail.index), tail_rows)
+            tails[asset] = ((stat.st_mtime, stat.st_size), start + len(new_values),
+                            Table(np.concatenate([tail.values, new_values])[-n_keep:], tail.columns,
+                                  tail.index.append(table.index)[-n_keep:]))
+    change = Change(asset, start, table)
+    for listener in listeners:
+        listener(change)
+    return change
+
+
+# Appends rows to a .npy file in place: the data is written before the header grows to include it.
+# Rewrites the file when the new shape does not fit the header.
+def append_store(store_path, values):
+    with open(store_path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_size = f.tell()
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+            'shape': (shape[0] + len(values),) + tuple(shape[1:])})
+        if version == (1, 0) and len(header.getvalue()) == header_size and not fortran_order:
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+    save_array(store_path, np.concatenate([np.load(store_path), values.astype(dtype)]))
+
+
+# Last n_row valid rows of an asset, from the tail when it is current: O(n_row) instead of a full load
+def load_tail(asset, n_row, is_prediction=False, dtype_policy=dtype_policy):
+    with span('load_tail', asset=asset):
+        n_load = max(n_row, tail_rows)
+        while True:
+            n_store, tail = get_tail(asset, n_load)
+            if is_prediction:
+                valid = ~np.isnan(tail.values[:, :-n_label]).any(axis=1)
+            else:
+                valid = ~np.isnan(tail.values).any(axis=1)
+            if valid.sum() >= n_row or len(tail.index) >= n_store:
+                break
+            n_load *= 2
+        rows = np.flatnonzero(valid)[-n_row:]
+        return Table(tail.values[rows].astype(get_dtypes(dtype_policy)[0], copy=False), tail.columns,
+                     tail.index[rows])
+
+
+# Store row count and the newest n_row rows of an asset, cached in tails
+def get_tail(asset, n_row):
+    stat = os.stat(get_data_file_path(asset))
+    if asset in tails:
+        key, n_store, tail = tails[asset]
+        if key == (stat.st_mtime, stat.st_size) and (len(tail.index) >= n_row or len(tail.index) >= n_store):
+            return n_store, tail
+    values, schema = load_store(asset)
+    tail = Table(np.array(values[-n_row:]), pd.Index(schema['columns']),
+                 pd.Index(schema['index'][-n_row:], name=schema['index_name']))
+    tails[asset] = ((schema['mtime'], schema['size']), values.shape[0], tail)
+    return values.shape[0], tail
+
+
+###############
+# IO
+###############
+def get_data_file_path(asset):
+    return 'data/{}.csv'.format(asset)
+
+
+def get_store_file_path(asset, dtype=np.float64):
+    if np.dtype(dtype) == np.float64:
+        return os.path.join('output/cache', '{}.npy'.format(asset))
+    return os.path.join('output/cache', '{}.{}.npy'.format(asset, np.dtype(dtype).name))
+
+
+# Stores of the other dtypes of an asset that exist
+def get_dtype_store_file_paths(asset):
+    file_paths = [get_store_file_path(asset, dtype) for dtype, _ in dtype_policies.values() if dtype != np.float64]
+    return [file_path for file_path in file_paths if os.path.exists(file_path)]
+
+
+def get_schema_file_path(asset):
+    return os.path.join('output/cache', '{}.json'.format(asset))
+
+
 if __name__ == '__main__':
     d = load_data('hsi')
     print(d.columns)
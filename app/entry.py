@@ -1,46 +1,125 @@
 import os
-import pandas as pd
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from itertools import product
 
-from app.data import load_data, get_classification_data
-from app.model import get_model
-from app.simulation import classification
-from app.constant import target_assets, label_indices
+import pandas as pd
+
+from app.data import load_data, load_table, load_tail, get_classification_data
+from app.model import get_model, limit_threads, get_worker_threads
+from app.constant import target_assets, label_indices, n_train_workers, n_train_threads, multi_label_training, \
+    async_prediction
+from app.report import flush_reports
+from app.timing import span
 
 
-def get_prediction(assets=target_assets):
+# ensemble: average the selected model with the saved runner-ups
+def get_prediction(assets=target_assets, ensemble=False):
     # Load selection
     selections = load_selection_result()
 
     # Generate new model
-    old_targets = set(zip(selections.assets.values, selections.label_index.values)) if selections is not None else set()
+    old_targets = set(zip(selections.asset.values, selections.label_index.values)) if selections is not None else set()
     new_targets = set(list(product(target_assets, label_indices))).difference(old_targets)
     if new_targets:
-        new_selections = generate_model(new_targets)
-        selections = save_selection_result(selections, new_selections)
+        selections = generate_model(new_targets, selections)
+        if selections is None:
+            return
 
     # Generate prediction
-    for _, selection in selections.iterrows():
-        if selection['asset'] not in assets or selection['label_index'] not in label_indices:
-            continue
-        generate_prediction(selection)
+    selections = selections[selections.asset.isin(assets) & selections.label_index.isin(label_indices)]
+    if len(selections) and async_prediction:
+        # Selections run concurrently, each with its own inference engine
+        from app.pipeline import run_predictions
+        run_predictions(selections, ensemble)
+    elif len(selections):
+        generate_predictions(selections, ensemble)
     return
 
 
-def generate_model(targets):
-    best_performances = []
-    for asset, label_index in targets:
-        d = load_data(asset, is_prediction=False)
-        best_performances.append(classification(asset, d, model_names=['gbdt', 'lr', 'rnn'], label_index=label_index, is_production=True))
-    return pd.DataFrame(best_performances)
-
-
-def generate_prediction(selection):
+# Train targets in worker processes. The selection is saved after every finished target in target order,
+# so a rerun after a crash only trains the failed targets. multi_label trains the labels of an asset together.
+def generate_model(targets, selections=None, n_workers=n_train_workers, n_threads=n_train_threads,
+                   multi_label=multi_label_training):
+    targets = sorted(targets)
+    best_performances = {}
+    failed_targets = []
+    if multi_label:
+        assets = sorted(set(asset for asset, _ in targets))
+        jobs = [(asset, [label_index for a, label_index in targets if a == asset]) for asset in assets]
+    else:
+        jobs = [(asset, [label_index]) for asset, label_index in targets]
+
+    def checkpoint(asset, label_indices, job_performances):
+        for label_index, best_performance in zip(label_indices, job_performances):
+            best_performances[(asset, label_index)] = best_performance
+        save_selection_result(None, pd.DataFrame(job_performances))
+
+    if n_workers <= 1:
+        for asset, job_label_indices in jobs:
+            try:
+                checkpoint(asset, job_label_indices, train_targets(asset, job_label_indices, n_threads))
+            except Exception:
+                traceback.print_exc()
+                failed_targets += [(asset, label_index) for label_index in job_label_indices]
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        n_threads = get_worker_threads(n_workers, n_threads)
+        futures = dict((executor.submit(train_targets, asset, job_label_indices, n_threads), (asset, job_label_indices))
+                       for asset, job_label_indices in jobs)
+        for future in as_completed(futures):
+            asset, job_label_indices = futures[future]
+            try:
+                checkpoint(asset, job_label_indices, future.result())
+            except Exception:
+                traceback.print_exc()
+                failed_targets += [(asset, label_index) for label_index in job_label_indices]
+        executor.shutdown(wait=True)
+    if failed_targets:
+        print('failed targets: {}'.format(sorted(failed_targets)))
+    if not best_performances:
+        return selections
+    new_selections = pd.DataFrame([best_performances[t] for t in targets if t in best_performances])
+    return compact_selection_result(new_selections if selections is None else pd.concat([selections, new_selections]))
+
+
+# Best performances of the labels of an asset, trained together when there are several
+def train_targets(asset, label_indices, n_threads=None):
+    # Training backends are only imported when a target is trained
+    from app.simulation import classification, multi_label_classification
+    if n_threads:
+        limit_threads(n_threads)
+    with span('train_target', asset=asset, label_index=','.join(str(i) for i in label_indices)):
+        d = load_table(asset, is_prediction=False)
+        try:
+            if len(label_indices) == 1:
+                return [classification(asset, d, model_names=['gbdt', 'lr', 'rnn'], label_index=label_indices[0],
+                                       is_production=True)]
+            return multi_label_classification(asset, d, model_names=['gbdt', 'lr', 'rnn'],
+                                              label_indices=label_indices, is_production=True)
+        finally:
+            # Worker processes exit without atexit handlers
+            flush_reports()
+
+
+# All selections in one batched pass of the inference engine
+def generate_predictions(selections, ensemble=False):
+    from app.inference import InferenceEngine
+    with span('generate_predictions', n_selection=len(selections), ensemble=ensemble):
+        results = InferenceEngine(selections, ensemble).predict()
+    for result in results:
+        new_result = pd.DataFrame([result], columns=['date', 'asset', 'label', 'score', 'prediction'])
+        save_prediction_result(result['asset'], result['label'], new_result)
+
+
+# One selection with its own data and model load: the per selection baseline of benchmark_inference
+def predict_selection(selection):
     asset, label_index = selection['asset'], selection['label_index']
     model_name, model_path, threshold = selection['model_name'], selection['model_path'], selection['threshold']
 
     # Load data
-    data = load_data(asset, is_prediction=True).iloc[-30:, :]
+    data = load_tail(asset, 30, is_prediction=True)
     xs, ys, feature_names, label_name = get_classification_data(data, label_index=label_index)
 
     # Load model
@@ -49,48 +128,97 @@ def generate_prediction(selection):
 
     # Generate prediction
     scores, predictions = model.predict(xs, threshold)
-    result = load_prediction_result(asset, label_name)
-    new_result = pd.DataFrame([[data.index[-1], scores[-1], predictions[-1]]], columns=['date', 'score', 'prediction'])
-    save_prediction_result(asset, label_name, result, new_result)
+    new_result = pd.DataFrame([[data.index[-1], asset, label_name, scores[-1], predictions[-1]]],
+                              columns=['date', 'asset', 'label', 'score', 'prediction'])
+    save_prediction_result(asset, label_name, new_result)
     return
 
 
 ###############
 # IO
 ###############
+# Selections and predictions are append-only csv journals: rows are appended and fsync'd, readers see the
+# last row per key.
 def save_selection_result(d1, d2):
-    if d1 is None:
-        d1 = d2
-    else:
-        d1 = pd.concat([d1, d2])
-    d1.to_csv(get_selection_file_path(), index=False)
-    return d1
+    append_rows(get_selection_file_path(), d2)
+    return compact_selection_result(d2 if d1 is None else pd.concat([d1, d2]))
 
 
 def load_selection_result():
     file_path = get_selection_file_path()
     if os.path.exists(file_path):
-        return pd.read_csv(file_path)
+        return compact_selection_result(pd.read_csv(file_path))
     else:
         return None
 
 
-def save_prediction_result(asset, label_name, d1, d2):
-    if d1 is None:
-        d1 = d2
-    else:
-        d1 = pd.concat([d1, d2])
-    d1.to_csv(get_prediction_file_path(asset, label_name), index=False)
+def compact_selection_result(d):
+    return d.drop_duplicates(['asset', 'label_index'], keep='last').reset_index(drop=True)
+
+
+def save_prediction_result(asset, label_name, d):
+    append_rows(get_prediction_file_path(asset, label_name), d)
 
 
 def load_prediction_result(asset, label_name):
     file_path = get_prediction_file_path(asset, label_name)
     if os.path.exists(file_path):
-        return pd.read_csv(file_path)
+        d = pd.read_csv(file_path)
+        # Rows written before the journal have no asset and label
+        d['asset'] = d['asset'].fillna(asset) if 'asset' in d else asset
+        d['label'] = d['label'].fillna(label_name) if 'label' in d else label_name
+        return d.drop_duplicates(['date', 'asset', 'label'], keep='last').reset_index(drop=True)
     else:
         return None
 
 
+# Rows are appended with one O_APPEND write, so concurrent writers do not clobber each other. A journal with
+# other columns is rewritten once with the union of columns.
+def append_rows(file_path, d):
+    if not os.path.exists(file_path):
+        create_journal(file_path, list(d.columns))
+    with open(file_path) as f:
+        columns = pd.read_csv(f, nrows=0).columns.tolist()
+    if set(d.columns) != set(columns):
+        write_atomic(file_path, pd.concat([pd.read_csv(file_path), d]))
+        return
+    data = d.reindex(columns=columns).to_csv(header=False, index=False).encode('utf-8')
+    fd = os.open(file_path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# The header is written to a temporary file and linked into place, so a journal never lacks its header
+def create_journal(file_path, columns):
+    directory = os.path.dirname(file_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.link(tmp_path, file_path)
+    except OSError:
+        # Created by another writer
+        pass
+    finally:
+        os.remove(tmp_path)
+
+
+def write_atomic(file_path, d):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+    with os.fdopen(fd, 'w') as f:
+        d.to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, file_path)
+
+
 def get_selection_file_path():
     return os.path.join('output/model/selection.csv')
 
@@ -0,0 +1,153 @@
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from app.compiled import load_compiled, get_compiled_file_path
+from app.constant import n_label, compiled_inference
+from app.data import load_tail
+from app.model import get_model, get_model_file_path
+from app.timing import span
+
+# Feature rows per prediction, as in predict_selection
+n_history = 30
+
+# A model scoring a selection: the selected model or a runner-up
+Member = namedtuple('Member', ['selection', 'model_name', 'model_path', 'threshold'])
+
+
+# Models of the selections loaded once. predict stacks the newest rows of all selections and runs each backend
+# once: every booster on one DMatrix, the logistic regressions as one matrix product and the rnn models in one
+# keras predict call. With ensemble, the saved runner-ups also score every selection and the prediction is the
+# average score against the average threshold. With compiled, lr and xgboost models saved with a compiled
+# predictor are loaded and scored by it, without sklearn or xgboost.
+class InferenceEngine(object):
+    def __init__(self, selections, ensemble=False, compiled=compiled_inference):
+        self.selections = selections.reset_index(drop=True)
+        self.ensemble = ensemble
+        self.compiled = compiled
+        self.compiled_paths = set()
+        self.members = []
+        self.models = {}
+        self.feature_names = {}
+        self.rnn_model = None
+        self.load()
+
+    def load(self):
+        for i, selection in self.selections.iterrows():
+            self.members.append(Member(i, selection['model_name'], selection['model_path'],
+                                       float(selection['threshold'])))
+            if self.ensemble and isinstance(selection.get('runner_ups'), str):
+                thresholds = str(selection['runner_up_thresholds']).split(';')
+                for model_name, threshold in zip(selection['runner_ups'].split(';'), thresholds):
+                    model_path = get_model_file_path(selection['asset'], selection['label'], model_name)
+                    if os.path.exists(model_path):
+                        self.members.append(Member(i, model_name, model_path, float(threshold)))
+        for member in self.members:
+            if member.model_path in self.models:
+                continue
+            compiled_path = get_compiled_file_path(member.model_path)
+            # A compiled predictor older than its model is stale
+            if self.compiled and member.model_name in ['gbdt', 'lr'] and os.path.exists(compiled_path) and \
+                    os.path.getmtime(compiled_path) >= os.path.getmtime(member.model_path):
+                self.models[member.model_path] = load_compiled(compiled_path)
+                self.compiled_paths.add(member.model_path)
+                continue
+            asset = self.selections['asset'][member.selection]
+            if asset not in self.feature_names:
+                self.feature_names[asset] = list(load_tail(asset, 1, is_prediction=True).columns[:-n_label])
+            model = get_model(member.model_name, target='classification', feature_names=self.feature_names[asset])
+            model.load_model(member.model_path)
+            self.models[member.model_path] = model
+        rnn_models = [self.models[m.model_path] for m in self.members if m.model_name == 'rnn']
+        if rnn_models:
+            self.rnn_model = get_joined_model([model.model for model in rnn_models])
+
+    # Newest feature rows and date of every selected asset
+    def load_histories(self):
+        histories = {}
+        for asset in self.selections['asset'].unique():
+            d = load_tail(asset, n_history, is_prediction=True)
+            histories[asset] = (d.values[:, :-n_label], d.index[-1])
+        return histories
+
+    # One result per selection: asset, label_index, label, model_name ('ensemble' with runner-ups), date, score
+    # and prediction
+    def predict(self, histories=None):
+        histories = histories or self.load_histories()
+        scores = np.zeros(len(self.members))
+        backends = ['compiled' if m.model_path in self.compiled_paths else m.model_name for m in self.members]
+        for model_name, predict_members in [('compiled', self.predict_compiled), ('gbdt', self.predict_xgb),
+                                            ('lr', self.predict_lr), ('rnn', self.predict_rnn)]:
+            indices = [i for i, backend in enumerate(backends) if backend == model_name]
+            if indices:
+                with span('predict_members', model_name=model_name):
+                    xs = [histories[self.selections['asset'][self.members[i].selection]][0] for i in indices]
+                    scores[indices] = predict_members([self.members[i] for i in indices], xs)
+
+        selection_indices = np.array([m.selection for m in self.members])
+        thresholds = np.array([m.threshold for m in self.members])
+        results = []
+        for i, selection in self.selections.iterrows():
+            members = selection_indices == i
+            score, threshold = scores[members].mean(), thresholds[members].mean()
+            model_name = 'ensemble' if members.sum() > 1 else selection['model_name']
+            results.append({'asset': selection['asset'], 'label_index': int(selection['label_index']),
+                            'label': selection['label'], 'model_name': model_name,
+                            'date': histories[selection['asset']][1], 'score': float(score),
+                            'prediction': int(score > threshold)})
+        return results
+
+    # Compiled predictors score the newest row of their selection
+    def predict_compiled(self, members, xs):
+        return [self.models[m.model_path].predict(x[-1:])[0] for m, x in zip(members, xs)]
+
+    # Every booster scores one DMatrix of the newest rows and keeps its own row
+    def predict_xgb(self, members, xs):
+        import xgboost as xgb
+        d_matrix = xgb.DMatrix(np.array([x[-1] for x in xs]))
+        return [self.models[m.model_path].model.predict(d_matrix, validate_features=False)[k]
+                for k, m in enumerate(members)]
+
+    # Logistic regression probabilities of the newest rows as one product with the stacked coefficients
+    def predict_lr(self, members, xs):
+        models = [self.models[m.model_path].model for m in members]
+        coefs = np.array([model.coef_[0] for model in models])
+        intercepts = np.array([model.intercept_[0] for model in models])
+        logits = (np.array([x[-1] for x in xs]) * coefs).sum(axis=1) + intercepts
+        return 1 / (1 + np.exp(-logits))
+
+    # The newest window of every rnn member, scaled by its scaler, in one predict call of the joined model
+    def predict_rnn(self, members, xs):
+        windows = []
+        for member, x in zip(members, xs):
+            model = self.models[member.model_path]
+            windows.append(model.scaler.transform(x[-model.rnn_length:]).astype(x.dtype, copy=False)[np.newaxis])
+        outputs = self.rnn_model.predict(windows)
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+        indices = [self.models[m.model_path].output_index for m in members]
+        return [output[0, 0 if index is None else index] for output, index in zip(outputs, indices)]
+
+    # Predictions per second of predict on loaded histories
+    def measure_throughput(self, n_repeat=10):
+        histories = self.load_histories()
+        start = time.time()
+        for _ in range(n_repeat):
+            self.predict(histories)
+        return n_repeat * len(self.selections) / (time.time() - start)
+
+
+# One keras model with an input and an output per model, so all models run in one predict call
+def get_joined_model(models):
+    from keras.layers import Input
+    from keras.models import Model as KerasModel
+    inputs, outputs = [], []
+    for i, model in enumerate(models):
+        # Loaded models can share a name
+        model.name = 'member_{}'.format(i)
+        x = Input(shape=model.input_shape[1:])
+        inputs.append(x)
+        outputs.append(model(x))
+    return KerasModel(inputs, outputs)
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+###############
+# Weights
+###############
+# Sample weights decaying from the newest row (1) to the oldest (decay_ratio ** (n - 1))
+def get_weights(ys, decay_ratio=0.995):
+    return np.power(float(decay_ratio), np.arange(len(ys) - 1, -1, -1, dtype=float))
+
+
+# Weights of n rows for every decay ratio: n_ratio x n
+def get_decay_weights(n, decay_ratios):
+    return np.power(np.asarray(decay_ratios, dtype=float)[:, np.newaxis], np.arange(n - 1, -1, -1, dtype=float))
+
+
+###############
+# Metrics
+###############
+# Accuracy, precision, recall and f1 of binary predictions (..., n) against gts (n) from the confusion counts.
+# weights: n or n_weighting x n sample weights, the latter adds a leading n_weighting axis to the metrics.
+# Precision and recall without predicted or actual positives are 0, as in sklearn.
+def get_confusion_metrics(gts, predictions, weights=None):
+    gts = np.asarray(gts).astype(bool)
+    predictions = np.asarray(predictions).astype(float)
+    sample_weights = np.ones((1, len(gts))) if weights is None else np.atleast_2d(weights).astype(float)
+    # Counts: ... x n_weighting
+    tp = np.dot(predictions, (sample_weights * gts).T)
+    n_prediction = np.dot(predictions, sample_weights.T)
+    n_gt = (sample_weights * gts).sum(axis=1)
+    total = sample_weights.sum(axis=1)
+    tn = total - n_gt - n_prediction + tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = (tp + tn) / total
+        precision = np.where(n_prediction > 0, tp / n_prediction, 0.0)
+        recall = np.where(n_gt > 0, tp / n_gt, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    metrics = {'accuracy': accuracy, 'precision': precision, 'recall': recall, 'f1': f1}
+    for name, values in metrics.items():
+        values = np.moveaxis(values, -1, 0)
+        metrics[name] = values if weights is not None and np.ndim(weights) == 2 else values[0]
+    return metrics
+
+
+# Metrics of predictions (score > threshold) for every threshold at once: scores (..., n) give
+# (..., n_threshold) metrics, e.g. one row of scores per decay ratio
+def evaluate_thresholds(gts, scores, thresholds, weights=None):
+    predictions = np.asarray(scores)[..., np.newaxis, :] > np.asarray(thresholds)[:, np.newaxis]
+    return get_confusion_metrics(gts, predictions, weights)
+
+
+# Area under the ROC curve of scores (..., n) from the ranks of the positives, ties ranked by their average.
+# NaN when gts has a single class.
+def get_auc(gts, scores):
+    gts = np.asarray(gts).astype(bool)
+    scores = np.asarray(scores)
+    n_pos, n = gts.sum(), len(gts)
+    if n_pos == 0 or n_pos == n:
+        return np.full(scores.shape[:-1], np.nan) if scores.ndim > 1 else np.nan
+    order = np.argsort(scores, axis=-1, kind='mergesort')
+    sorted_scores = np.sort(scores, axis=-1, kind='mergesort')
+    positions = np.arange(1, n + 1)
+    is_start = np.ones(sorted_scores.shape, dtype=bool)
+    is_start[..., 1:] = sorted_scores[..., 1:] != sorted_scores[..., :-1]
+    is_end = np.ones(sorted_scores.shape, dtype=bool)
+    is_end[..., :-1] = is_start[..., 1:]
+    first = np.maximum.accumulate(np.where(is_start, positions, 0), axis=-1)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(is_end, positions, n + 1), -1), axis=-1), -1)
+    ranks = (first + last) / 2.0
+    auc = ((ranks * gts[order]).sum(axis=-1) - n_pos * (n_pos + 1) / 2.0) / (n_pos * (n - n_pos))
+    return auc if scores.ndim > 1 else float(auc)
+
+
+# auc, accuracy, f1, precision and recall in one pass over arrays. Batched predictions and scores (..., n) give
+# arrays of metrics, a single row gives floats. auc is None without scores.
+def evaluate_classification(gts, predictions, scores=None, weights=None):
+    metrics = get_confusion_metrics(gts, predictions, weights)
+    metrics['auc'] = None if scores is None else get_auc(gts, scores)
+    for name, values in metrics.items():
+        if values is not None and np.ndim(values) == 0:
+            metrics[name] = float(values)
+    return metrics
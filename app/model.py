@@ -1,50 +1,98 @@
 import copy
+import math
+import multiprocessing
 import os
 import pickle
+import shutil
+import tempfile
 from itertools import product
 
 import numpy as np
-import xgboost as xgb
-from keras import Sequential
-from keras.callbacks import EarlyStopping
-from keras.layers import LSTM, Dense, BatchNormalization
-from keras.models import load_model
-from keras.optimizers import Adam
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import log_loss, roc_auc_score, f1_score, accuracy_score, precision_score, recall_score
-from sklearn.preprocessing import StandardScaler
-
-from app.util import get_precision_recall_curve
+from numpy.lib.stride_tricks import as_strided
+
+from app.cache import get_dmatrix, get_cv_folds
+from app.compiled import CompiledLR, compile_trees, save_compiled, load_compiled, get_compiled_file_path, \
+    margin_tolerance
+from app.constant import n_search_workers, n_search_threads, model_search, model_search_seconds
+from app.metric import evaluate_classification, evaluate_thresholds
+from app.search import Uniform, Choice, get_searcher
+from app.timing import span, timed
+
+# Backends (xgboost, keras/tensorflow, sklearn) are imported where a model of that type is built or loaded
+
+# Thread budget of this process for tensorflow and xgboost (None: library defaults)
+thread_limit = None
+
+
+def limit_threads(n_threads):
+    global thread_limit
+    if n_threads == thread_limit:
+        return
+    thread_limit = n_threads
+    import tensorflow as tf
+    from keras import backend
+    # One tensorflow session per process
+    config = tf.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=1)
+    backend.set_session(tf.Session(config=config))
+
+
+# xgboost params with the thread budget of this process
+def get_thread_params(params):
+    if not thread_limit:
+        return params
+    return [dict(param, nthread=thread_limit) for param in params]
+
+
+# Threads per worker process: n_threads, or the cores shared between n_workers processes (None: one process
+# uses all cores)
+def get_worker_threads(n_workers, n_threads=None):
+    if n_threads or n_workers <= 1:
+        return n_threads
+    return max(1, multiprocessing.cpu_count() // n_workers)
+
 
 # model selection
 
-def get_model(model_name, target='classification', feature_names=[]):
+# search: hyperparameter searcher name or Searcher used by train
+# n_output: labels of a multi-output model (rnn only)
+def get_model(model_name, target='classification', feature_names=[], search=model_search,
+              search_seconds=model_search_seconds, n_output=1):
     if model_name == 'gbdt':
-        return XGBModel(model_name, target, feature_names)
+        model = XGBModel(model_name, target, feature_names)
     elif model_name == 'rnn':
-        return RNNModel(model_name, target, feature_names)
+        model = RNNModel(model_name, target, feature_names, n_output=n_output)
     elif model_name == 'lr':
-        return LRModel(model_name, target, feature_names)
+        model = LRModel(model_name, target, feature_names)
+    model.searcher = get_searcher(search, search_seconds)
+    return model
 
 
-def search_threshold(xs, ys, model, valid_size):
+# Score the validation rows once and evaluate every threshold on the scores.
+# thresholds: None for 0.1, ..., 0.9 or 'exact' for every distinct validation score.
+@timed('search_threshold')
+def search_threshold(xs, ys, model, valid_size, metric='accuracy', thresholds=None):
     xs, ys = xs[-valid_size:], ys[-valid_size:]
-    best_accuracy = 0
-    best_threshold = 0
-    accuracies = []
-    for i in range(1, 10):
-        threshold = i / 10.0
-        accuracy = model.test(xs, ys, threshold)['accuracy']
-        accuracies.append(accuracy)
-        if accuracy > best_accuracy:
-            best_accuracy = accuracy
-            best_threshold = threshold
-    print('best training accuracy {}/{}, threshold {}'.format(best_accuracy, accuracies, best_threshold))
+    scores, _ = model.predict(xs)
+    scores = np.asarray(scores)
+    if thresholds is None:
+        thresholds = np.arange(1, 10) / 10.0
+    elif isinstance(thresholds, str):
+        thresholds = np.unique(scores)
+    thresholds = np.asarray(thresholds, dtype=float)
+    # Compare in the score precision as predict does
+    values = evaluate_thresholds(model.get_test_labels(ys), scores, thresholds.astype(scores.dtype))[metric]
+    index = np.argmax(values)
+    best_value = values[index] if values[index] > 0 else 0
+    best_threshold = float(thresholds[index]) if values[index] > 0 else 0
+    print('best training {} {}/{}, threshold {}'.format(metric, best_value, values.tolist(), best_threshold))
     return best_threshold
 
 
-
 class Model(object):
+    # Hyperparameters searched by the searcher and the range of the search budget
+    search_space = {}
+    search_budget = (1, 1)
+
     def __init__(self, model_name, target='classification', feature_names=None):
         self.name = model_name
         print('{} model'.format(model_name))
@@ -52,6 +100,7 @@ class Model(object):
         self.model = None
         self.feature_names = feature_names
         self.status = {}
+        self.searcher = None
         return
 
     def train(self, train_xs, train_ys):
@@ -59,18 +108,10 @@ class Model(object):
 
     def test(self, test_xs, test_ys, threshold=0.5):
         scores, predictions = self.predict(test_xs, threshold)
-        return self.evaluate(test_ys, predictions, scores)
+        return self.evaluate(self.get_test_labels(test_ys), predictions, scores)
 
     def evaluate(self, gts, predictions, scores=None):
-        if not scores:
-            auc = None
-        else:
-            auc = roc_auc_score(gts, scores)
-        acc = accuracy_score(gts, predictions)
-        f1 = f1_score(gts, predictions)
-        precision = precision_score(gts, predictions)
-        recall = recall_score(gts, predictions)
-        return {'auc': auc, 'accuracy': acc, 'f1': f1, 'precision': precision, 'recall': recall}
+        return evaluate_classification(gts, predictions, scores)
 
     def predict(self, xs, threshold=0.5):
         raise NotImplementedError
@@ -84,108 +125,279 @@ class Model(object):
     def get_feature_importance(self):
         return None
 
-    def save_pr_curve(self, asset, label_name, xs, ys):
+    # Numpy predictor of the trained model (app.compiled), None when the model has none
+    def compile(self):
+        return None
+
+    # Settings that change the trained model, for the artifact cache
+    def get_config(self):
+        return {'class': type(self).__name__, 'target': self.target, 'feature_names': list(self.feature_names),
+                'search': self.searcher.get_config() if self.searcher else None}
+
+    # Best (config, info) of the searcher over search_space
+    def search_params(self, train_xs, train_ys):
+        objective = self.get_search_objective(train_xs, train_ys)
+        config, loss, info = self.searcher.search(self.search_space, objective, *self.search_budget)
+        self.status['search_loss'] = loss
+        return config, info
+
+    # objective(config, budget) -> (validation loss, info)
+    def get_search_objective(self, train_xs, train_ys):
+        raise NotImplementedError
+
+    # Labels aligned with the scores of predict
+    def get_test_labels(self, ys):
+        return ys
+
+    # Rendered by the report writer. scores: test scores of predict(xs) when already computed
+    def save_pr_curve(self, asset, label_name, xs, ys, scores=None):
+        from app.report import submit_report
+        from app.util import get_precision_recall_curve
         output_path = get_pr_curve_file_path(asset, label_name, self.name)
-        scores, _ = self.predict(xs)
-        if self.name == 'rnn':
-            ys = ys[self.rnn_length-1:]
-        get_precision_recall_curve(ys, scores, output_path)
+        if scores is None:
+            scores, _ = self.predict(xs)
+        submit_report(get_precision_recall_curve, self.get_test_labels(ys), scores, output_path)
 
 
 class XGBModel(Model):
+    # budget: boosting rounds
+    search_space = {'max_depth': Uniform(1, 30, log=True, integer=True), 'min_child_weight': Uniform(1, 10, log=True),
+                    'eta': Uniform(0.01, 0.3, log=True), 'subsample': Uniform(0.5, 1.0),
+                    'colsample_bytree': Uniform(0.5, 1.0)}
+    search_budget = (10, 100)
+
     def __init__(self, model_name, target, feature_names):
         super(XGBModel, self).__init__(model_name, target, feature_names)
+        # Training rows the compiled trees are checked on, and the compiled trees saved with a loaded model
+        self.train_xs = None
+        self.compiled = None
+
+    def get_config(self):
+        return dict(super(XGBModel, self).get_config(), params=get_xgb_classification_params())
 
     def train(self, train_xs, train_ys):
-        params = get_xgb_classification_params()
-        d_train = xgb.DMatrix(train_xs, label=train_ys, feature_names=self.feature_names)
-        best_param, best_round = xgb_param_selection(params, d_train, target='test-logloss-mean')
+        import xgboost as xgb
+        params = get_thread_params(get_xgb_classification_params())
+        d_train = get_dmatrix(train_xs, train_ys, feature_names=self.feature_names)
+        if self.searcher:
+            config, info = self.search_params(train_xs, train_ys)
+            best_param, best_round = dict(params[0], **config), info['round']
+        else:
+            best_param, best_round = xgb_param_selection(params, d_train, target='test-logloss-mean')
         self.model = xgb.train(best_param, d_train, num_boost_round=best_round, verbose_eval=False)
+        self.train_xs = train_xs
         self.status['train_loss'] = float(self.model.eval(d_train).split(':')[-1])
         return self.status
 
     def predict(self, xs, threshold=0.5):
-        d_matrix = xgb.DMatrix(xs, feature_names=self.feature_names)
-        scores = list(self.model.predict(d_matrix))
-        predictions = list((np.array(scores) > threshold).astype(int))
+        d_matrix = get_dmatrix(xs, feature_names=self.feature_names)
+        scores = self.model.predict(d_matrix)
+        predictions = (scores > threshold).astype(int)
         return scores, predictions
 
+    def get_search_objective(self, train_xs, train_ys):
+        param = get_xgb_classification_params()[0]
+        if thread_limit:
+            param['nthread'] = thread_limit
+        folds = get_cv_folds(get_dmatrix(train_xs, train_ys, feature_names=self.feature_names))
+
+        def objective(config, budget):
+            loss, best_round = xgb_cv(dict(param, **config), folds, 'test-logloss-mean', num_boost_round=int(budget))
+            return loss, {'round': best_round}
+        return objective
+
     def get_feature_importance(self):
         feature_importance = sorted(self.model.get_fscore().items(), key=lambda x: x[1], reverse=True)
         return feature_importance
 
     def load_model(self, file_path=None):
+        import xgboost as xgb
         self.model = xgb.Booster()
         self.model.load_model(file_path)
+        # Checked when it was saved
+        compiled_path = get_compiled_file_path(file_path)
+        self.train_xs = None
+        self.compiled = load_compiled(compiled_path) if os.path.exists(compiled_path) else None
 
     def save_model(self, file_path=None):
         self.model.save_model(file_path)
+        save_compiled(get_compiled_file_path(file_path), self.compile())
+
+    # The trees of the model dump, with the base margin of the booster: its margin of a row less the leaf values.
+    # Split values of the text dump may be rounded, so the trees are only kept when their margins of the training
+    # rows match the booster; without training rows (a loaded model) the trees saved with the model are kept.
+    def compile(self):
+        if self.train_xs is None:
+            return self.compiled
+        trees = compile_trees(self.model.get_dump(), self.feature_names)
+        xs = np.zeros((1, len(self.feature_names)), dtype=np.float32)
+        margin = self.model.predict(get_dmatrix(xs, feature_names=self.feature_names), output_margin=True)[0]
+        trees.base_margin = np.float32(margin) - trees.get_margin(xs)[0]
+        margins = self.model.predict(get_dmatrix(self.train_xs, feature_names=self.feature_names), output_margin=True)
+        difference = np.max(np.abs(trees.get_margin(self.train_xs) - margins))
+        if difference > margin_tolerance * max(1.0, np.max(np.abs(margins))):
+            print('compiled trees differ from the booster by {}, not compiled'.format(difference))
+            return None
+        return trees
 
 
 # input: previous more length data
 class RNNModel(Model):
-    def __init__(self, model_name, target, feature_names, rnn_length=20):
+    # budget: epochs
+    search_space = {'units': Choice([(5, 5), (10, 5), (20, 10), (40, 20), (64, 32)]),
+                    'learning_rate': Uniform(1e-4, 1e-2, log=True)}
+    search_budget = (10, 270)
+
+    # fine_tune_epochs: epochs trained on the validation sequences after restoring the best weights.
+    # n_output: labels of a multi-output model, trained on n_row x n_output labels with a sigmoid output per label;
+    # output_index selects the output scored by predict.
+    def __init__(self, model_name, target, feature_names, rnn_length=20, fine_tune_epochs=0, n_output=1):
         super(RNNModel, self).__init__(model_name, target, feature_names)
         self.rnn_length = rnn_length
         self.batch_size = 128
+        self.fine_tune_epochs = fine_tune_epochs
+        self.n_output = n_output
+        self.output_index = None
         self.scaler = None
 
+    def get_config(self):
+        return dict(super(RNNModel, self).get_config(), rnn_length=self.rnn_length, batch_size=self.batch_size,
+                    fine_tune_epochs=self.fine_tune_epochs, n_output=self.n_output)
+
+    # The model of one label of a multi-output model, sharing the keras model and the scaler
+    def get_output_model(self, output_index):
+        model = copy.copy(self)
+        model.output_index = output_index
+        model.status = dict(self.status)
+        return model
+
+    # One pass with early stopping on the last third of the sequences, keeping the weights of the best epoch.
+    # Sequences are streamed to keras in batches.
     def train(self, train_xs, train_ys):
+        from keras.callbacks import EarlyStopping
+        from sklearn.preprocessing import StandardScaler
         # Normalized by training data
+        # Scaled in the feature dtype
         self.scaler = StandardScaler().fit(train_xs)
-        norm_xs = self.scaler.transform(train_xs)
-        sequence_xs, sequence_ys = get_rnn_data(norm_xs, train_ys, self.rnn_length)
-        model = get_rnn_model(self.rnn_length, len(self.feature_names), target=self.target)
+        norm_xs = self.scaler.transform(train_xs).astype(train_xs.dtype, copy=False)
+        config = self.search_params(train_xs, train_ys)[0] if self.searcher else {}
+        self.model = get_rnn_model(self.rnn_length, len(self.feature_names), target=self.target,
+                                   n_output=self.n_output, **config)
+
+        # Same split as keras validation_split
+        n_fit = int((len(train_ys) - self.rnn_length + 1) * (1 - 1.0 / 3))
+        n_fit_row = n_fit + self.rnn_length - 1
+        fit_batches, fit_steps = get_rnn_batches(norm_xs[:n_fit_row], train_ys[:n_fit_row], self.rnn_length,
+                                                 self.batch_size, shuffle=True)
+        valid_batches, valid_steps = get_rnn_batches(norm_xs[n_fit:], train_ys[n_fit:], self.rnn_length,
+                                                     self.batch_size)
         early_stopping = EarlyStopping(patience=50, monitor='val_loss')
-        history = model.fit(sequence_xs, sequence_ys, batch_size=self.batch_size, epochs=1000,
-                            validation_split=1.0 / 3, callbacks=[early_stopping], shuffle=True)
-        best_epoch = np.argmin(history.history['val_loss'])
-        self.model = get_rnn_model(self.rnn_length, len(self.feature_names), target=self.target)
-        self.model.fit(sequence_xs, sequence_ys, batch_size=self.batch_size, epochs=best_epoch)
-        self.status['train_loss'] = self.model.evaluate(sequence_xs, sequence_ys)[0]
+        best_weights, best = get_best_weights_callback(self.model)
+        self.model.fit_generator(fit_batches, fit_steps, epochs=1000, validation_data=valid_batches,
+                                 validation_steps=valid_steps, callbacks=[early_stopping, best_weights])
+        if self.fine_tune_epochs:
+            self.model.fit_generator(valid_batches, valid_steps, epochs=self.fine_tune_epochs)
+        batches, steps = get_rnn_batches(norm_xs, train_ys, self.rnn_length, self.batch_size)
+        self.status['train_loss'] = self.model.evaluate_generator(batches, steps)[0]
+        self.status['best_epoch'] = best['epoch']
         return self.status
 
-    def test(self, test_xs, test_ys, threshold=0.5):
-        scores, predictions = self.predict(test_xs, threshold)
-        return self.evaluate(test_ys[self.rnn_length - 1:], predictions, scores)
+    def get_search_objective(self, train_xs, train_ys):
+        from sklearn.preprocessing import StandardScaler
+        scaler = self.scaler or StandardScaler().fit(train_xs)
+        sequence_xs, sequence_ys = get_rnn_data(scaler.transform(train_xs).astype(train_xs.dtype, copy=False),
+                                                train_ys, self.rnn_length)
+
+        def objective(config, budget):
+            model = get_rnn_model(self.rnn_length, len(self.feature_names), target=self.target,
+                                  n_output=self.n_output, **config)
+            history = model.fit(sequence_xs, sequence_ys, batch_size=self.batch_size, epochs=int(budget),
+                                validation_split=1.0 / 3, shuffle=True, verbose=0)
+            return min(history.history['val_loss']), {'epoch': int(np.argmin(history.history['val_loss'])) + 1}
+        return objective
+
+    def get_test_labels(self, ys):
+        return ys[self.rnn_length - 1:]
 
     def predict(self, xs, threshold=0.5):
-        norm_xs = self.scaler.transform(xs)
+        norm_xs = self.scaler.transform(xs).astype(xs.dtype, copy=False)
         sequence_xs, _ = get_rnn_data(norm_xs, [], self.rnn_length)
-        scores = list(np.concatenate(self.model.predict(sequence_xs)))
-        predictions = list((np.array(scores) > threshold).astype(int))
+        # n_row x n_output scores of a multi-output model without output_index
+        scores = self.model.predict(sequence_xs)
+        if self.output_index is not None:
+            scores = scores[:, self.output_index]
+        elif scores.shape[1] == 1:
+            scores = scores[:, 0]
+        predictions = (scores > threshold).astype(int)
         return scores, predictions
 
     def load_model(self, file_path=None):
+        from keras.models import load_model
         self.model = load_model(file_path)
         scaler_path = self.get_scaler_file_path(file_path)
         with open(scaler_path, 'rb') as f:
             self.scaler = pickle.load(f)
+        output_path = self.get_output_file_path(file_path)
+        if os.path.exists(output_path):
+            with open(output_path) as f:
+                self.output_index = int(f.read())
 
     def save_model(self, file_path=None):
         self.model.save(file_path)
         scaler_path = self.get_scaler_file_path(file_path)
         with open(scaler_path, 'wb') as f:
             pickle.dump(self.scaler, f, -1)
+        output_path = self.get_output_file_path(file_path)
+        if self.output_index is not None:
+            with open(output_path, 'w') as f:
+                f.write(str(self.output_index))
+        elif os.path.exists(output_path):
+            os.remove(output_path)
 
     @staticmethod
     def get_scaler_file_path(file_path):
         return file_path + '.scaler'
 
+    # Output index of a model saved from a multi-output model
+    @staticmethod
+    def get_output_file_path(file_path):
+        return file_path + '.output'
+
 
 class LRModel(Model):
+    # budget: solver iterations
+    search_space = {'C': Uniform(1e-3, 1e2, log=True)}
+    search_budget = (10, 100)
+
     def __init__(self, model_name, target, feature_names):
         super(LRModel, self).__init__(model_name, target, feature_names)
 
     def train(self, train_xs, train_ys):
-        self.model = LogisticRegression()
-        self.model.fit(train_xs, train_ys)
-        self.status['train_loss'] = log_loss(train_ys, list(self.model.predict_proba(train_xs)[:, 1]))
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.metrics import log_loss
+        config = self.search_params(train_xs, train_ys)[0] if self.searcher else {}
+        self.model = LogisticRegression(**config)
+        # Solved in float64 whatever the feature dtype, as liblinear does: float32 features only add their rounding
+        self.model.fit(np.asarray(train_xs, dtype=np.float64), train_ys)
+        self.status['train_loss'] = log_loss(train_ys, self.model.predict_proba(train_xs)[:, 1])
         return self.status
 
+    # Fit on the first two thirds of the training rows, validate on the last third
+    def get_search_objective(self, train_xs, train_ys):
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.metrics import log_loss
+        n_fit = len(train_ys) - len(train_ys) // 3
+        train_xs = np.asarray(train_xs, dtype=np.float64)
+        fit_xs, fit_ys, valid_xs, valid_ys = train_xs[:n_fit], train_ys[:n_fit], train_xs[n_fit:], train_ys[n_fit:]
+
+        def objective(config, budget):
+            model = LogisticRegression(max_iter=int(budget), **config).fit(fit_xs, fit_ys)
+            return log_loss(valid_ys, model.predict_proba(valid_xs)[:, 1], labels=[0, 1]), {}
+        return objective
+
     def predict(self, xs, threshold=0.5):
-        scores = list(self.model.predict_proba(xs)[:, 1])
-        predictions = list((np.array(scores) > threshold).astype(int))
+        scores = self.model.predict_proba(xs)[:, 1]
+        predictions = (scores > threshold).astype(int)
         return scores, predictions
 
     def load_model(self, file_path=None):
@@ -195,6 +407,10 @@ class LRModel(Model):
     def save_model(self, file_path=None):
         with open(file_path, 'wb') as f:
             pickle.dump(self.model, f, -1)
+        save_compiled(get_compiled_file_path(file_path), self.compile())
+
+    def compile(self):
+        return CompiledLR(self.model.coef_[0], self.model.intercept_[0])
 
 
 ###############
@@ -234,15 +450,17 @@ def get_xgb_regression_params():
     return params
 
 
-def xgb_param_selection(params, d_train, target='test-logloss-mean'):
+def xgb_param_selection(params, d_train, target='test-logloss-mean', n_workers=None, n_threads=None):
+    n_workers = n_workers or n_search_workers
+    if n_workers > 1:
+        return xgb_parallel_param_selection(params, d_train, target, n_workers, n_threads or n_search_threads)
     best_param = None
     best_round = None
     best_loss = None
     ls = []
     for param in params:
-        history = xgb.cv(param, d_train, num_boost_round=100, nfold=5, early_stopping_rounds=10, verbose_eval=False)
-        param_best_loss = min(history[target])
-        param_best_round = np.argmin(history[target])
+        with span('xgb_cv'):
+            param_best_loss, param_best_round = xgb_cv(param, get_cv_folds(d_train, nfold=5), target)
         ls.append(param_best_loss)
         if best_loss and best_loss < param_best_loss:
             continue
@@ -254,46 +472,163 @@ def xgb_param_selection(params, d_train, target='test-logloss-mean'):
     return best_param, best_round
 
 
+# Same search as the serial xgb.cv search over the grid, with every param cross validated in a process pool. The
+# folds of a param are boosted together and stopped early on their mean test loss, so each param does the work of
+# xgb.cv and the search selects the same param.
+def xgb_parallel_param_selection(params, d_train, target='test-logloss-mean', n_workers=4, n_threads=1,
+                                 num_boost_round=100, nfold=5, early_stopping_rounds=10):
+    from concurrent.futures import ProcessPoolExecutor
+    buffer_dir = tempfile.mkdtemp()
+    buffer_path = os.path.join(buffer_dir, 'train.buffer')
+    d_train.save_binary(buffer_path)
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        jobs = [executor.submit(xgb_cv_job, buffer_path, dict(param, nthread=n_threads), nfold, target,
+                                num_boost_round, early_stopping_rounds) for param in params]
+        ls = [job.result() for job in jobs]
+    finally:
+        executor.shutdown(wait=True)
+        shutil.rmtree(buffer_dir)
+
+    # Same tie breaking as the serial search: the last param reaching the best loss
+    best_param = None
+    best_round = None
+    best_loss = None
+    for param, (param_best_loss, param_best_round) in zip(params, ls):
+        if best_loss and best_loss < param_best_loss:
+            continue
+        best_param = param
+        best_round = param_best_round
+        best_loss = param_best_loss
+    print('xgb param selection loss: {} from {}, param: {}'.format(best_loss, [l[0] for l in ls], best_param))
+    return best_param, best_round
+
+
+# xgb.cv on cached folds: the fold boosters are trained round by round and stopped together on the mean test
+# loss of target, as xgb.cv early stopping does. Returns the best (loss, round).
+def xgb_cv(param, folds, target='test-logloss-mean', num_boost_round=100, early_stopping_rounds=10):
+    import xgboost as xgb
+    eval_name = target.rsplit('-', 1)[0]
+    metrics = param.get('eval_metric', [])
+    items = [(k, v) for k, v in param.items() if k != 'eval_metric']
+    items += [('eval_metric', metric) for metric in (metrics if isinstance(metrics, list) else [metrics])]
+    boosters = [xgb.Booster(items, [d_train, d_test]) for d_train, d_test in folds]
+    history = []
+    for i in range(num_boost_round):
+        losses = []
+        for booster, (d_train, d_test) in zip(boosters, folds):
+            booster.update(d_train, i)
+            result = dict(item.split(':') for item in booster.eval_set([(d_test, 'test')], i).split()[1:])
+            losses.append(float(result[eval_name]))
+        history.append(np.mean(losses))
+        _, best_round = early_stopped_best(history, early_stopping_rounds)
+        if i - best_round >= early_stopping_rounds:
+            break
+    return early_stopped_best(history, early_stopping_rounds)
+
+
+# xgb_cv of one param on the training data saved at buffer_path, run in a worker process
+def xgb_cv_job(buffer_path, param, nfold, target, num_boost_round=100, early_stopping_rounds=10):
+    import xgboost as xgb
+    if buffer_path not in fold_buffers:
+        fold_buffers.clear()
+        fold_buffers[buffer_path] = xgb.DMatrix(buffer_path)
+    with span('xgb_cv'):
+        return xgb_cv(param, get_cv_folds(fold_buffers[buffer_path], nfold=nfold), target, num_boost_round,
+                      early_stopping_rounds)
+
+
+fold_buffers = {}
+
+
+# Best (loss, round) of a mean cv history under xgb.cv early stopping
+def early_stopped_best(history, early_stopping_rounds=10):
+    best_round = 0
+    for i in range(len(history)):
+        if history[i] < history[best_round]:
+            best_round = i
+        elif i - best_round >= early_stopping_rounds:
+            break
+    return history[best_round], best_round
+
+
 ###############
 # RNN
 ###############
-def get_rnn_model(length, n_feature, target='regression'):
+def get_rnn_model(length, n_feature, target='regression', units=(10, 5), learning_rate=0.0005, n_output=1):
+    from keras import Sequential
+    from keras.layers import LSTM, Dense, BatchNormalization
+    from keras.optimizers import Adam
     # regulization = L1L2(0, 0.01)
     regulization = None
     model = Sequential()
     model.add(BatchNormalization(input_shape=(length, n_feature)))
-    model.add(LSTM(10, activation='sigmoid', return_sequences=True, kernel_regularizer=regulization))
+    model.add(LSTM(units[0], activation='sigmoid', return_sequences=True, kernel_regularizer=regulization))
     model.add(BatchNormalization())
-    model.add(LSTM(5, activation='sigmoid', return_sequences=False, kernel_regularizer=regulization))
-    optimizer = Adam(lr=0.0005)
+    model.add(LSTM(units[1], activation='sigmoid', return_sequences=False, kernel_regularizer=regulization))
+    optimizer = Adam(lr=learning_rate)
     # optimizer = SGD(lr=0.005)
     if target == 'regression':
         model.add(BatchNormalization())
-        model.add(Dense(1, activation='linear', kernel_regularizer=regulization))
+        model.add(Dense(n_output, activation='linear', kernel_regularizer=regulization))
         model.compile(loss='mean_squared_error', optimizer=optimizer, metrics=['mse'])
     else:
         model.add(BatchNormalization())
-        model.add(Dense(1, activation='sigmoid', kernel_regularizer=regulization))
+        model.add(Dense(n_output, activation='sigmoid', kernel_regularizer=regulization))
         model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=['accuracy'])
     print(model.summary())
     return model
 
 
-# Truncate first length data
+# Truncate first length data. Sequences are a read-only strided view of xs (no copy).
 def get_rnn_data(xs, ys, length=20):
-    sequence_xs = []
-    for i in range(len(xs) - length + 1):
-        sequence_xs.append(xs[i:i + length])
-    sequence_xs = np.array(sequence_xs)
-    if ys:
+    xs = np.asarray(xs)
+    n_sequence = max(len(xs) - length + 1, 0)
+    sequence_xs = as_strided(xs, shape=(n_sequence, length) + xs.shape[1:], strides=(xs.strides[0],) + xs.strides,
+                             writeable=False)
+    if len(ys):
         sequence_ys = ys[length - 1:]
         sequence_ys = np.array(sequence_ys)
-        sequence_ys = sequence_ys.reshape(sequence_ys.shape[0], 1)
+        sequence_ys = sequence_ys.reshape(sequence_ys.shape[0], -1)
     else:
         sequence_ys = None
     return sequence_xs, sequence_ys
 
 
+# Endless batches of sequences for keras fit_generator/predict_generator, with steps per epoch.
+# Only the sequences of a batch are copied; shuffle reorders the sequences every epoch.
+def get_rnn_batches(xs, ys, length=20, batch_size=128, shuffle=False):
+    sequence_xs, sequence_ys = get_rnn_data(xs, ys, length)
+    n_step = int(math.ceil(len(sequence_xs) / float(batch_size)))
+
+    def generate():
+        while True:
+            order = np.random.permutation(len(sequence_xs)) if shuffle else np.arange(len(sequence_xs))
+            for i in range(0, len(sequence_xs), batch_size):
+                batch_xs = sequence_xs[order[i:i + batch_size]]
+                if sequence_ys is None:
+                    yield batch_xs
+                else:
+                    yield batch_xs, sequence_ys[order[i:i + batch_size]]
+    return generate(), n_step
+
+
+# Keeps the weights of the epoch with the lowest monitored loss and restores them when training ends.
+# Returns the callback and {'loss', 'epoch'} of the best epoch.
+def get_best_weights_callback(model, monitor='val_loss'):
+    from keras.callbacks import LambdaCallback
+    best = {'loss': np.inf, 'epoch': 0, 'weights': None}
+
+    def on_epoch_end(epoch, logs):
+        if logs[monitor] < best['loss']:
+            best.update({'loss': logs[monitor], 'epoch': epoch + 1, 'weights': model.get_weights()})
+
+    def on_train_end(logs):
+        if best['weights'] is not None:
+            model.set_weights(best['weights'])
+    return LambdaCallback(on_epoch_end=on_epoch_end, on_train_end=on_train_end), best
+
+
 ###############
 # IO
 ###############
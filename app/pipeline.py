@@ -0,0 +1,128 @@
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from app.constant import n_prediction_workers, n_io_workers, prediction_timeout
+from app.timing import span
+
+# Keras models are loaded and run one at a time: building keras graphs is not thread safe
+keras_lock = threading.Lock()
+
+
+# Predictions of all selections as concurrent futures. Per selection, a file thread loads the models and the
+# newest rows, submits the scoring to a bounded pool of inference threads and saves the result, so the file work
+# of one selection overlaps the inference of others and the run takes about as long as the slowest selection.
+# A failed selection does not stop the others.
+# Selections unfinished after timeout seconds are reported as timeout and never save their result. Threads can
+# not be stopped: a load or inference already running finishes in the background and the process only exits
+# after it, so the timeout bounds the wait for the report, not the run of the process.
+class PredictionPipeline(object):
+    def __init__(self, selections, ensemble=False, n_workers=n_prediction_workers, n_io_workers=n_io_workers,
+                 timeout=prediction_timeout):
+        self.selections = selections.reset_index(drop=True)
+        self.ensemble = ensemble
+        self.n_workers = n_workers
+        self.n_io_workers = n_io_workers
+        self.timeout = timeout
+        self.statuses = []
+        # Set at the timeout; checked by the file threads before saving, under lock
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.saving = set()
+        self.seconds = {}
+
+    # One status per selection: asset, label_index, status ('ok', 'failed' or 'timeout'), seconds and error
+    def run(self):
+        self.statuses = [{'asset': s['asset'], 'label_index': int(s['label_index']), 'status': 'timeout',
+                          'seconds': None, 'error': None} for _, s in self.selections.iterrows()]
+        self.cancelled.clear()
+        self.saving = set()
+        self.seconds = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        self.io_executor = ThreadPoolExecutor(max_workers=self.n_io_workers)
+        start = time.time()
+        try:
+            with span('prediction_pipeline', n_selection=len(self.selections), ensemble=self.ensemble):
+                self.predict_all()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.io_executor.shutdown(wait=False)
+        counts = pd.Series([s['status'] for s in self.statuses]).value_counts().to_dict()
+        slowest = max([s['seconds'] for s in self.statuses if s['seconds'] is not None] or [0])
+        print('predictions {} in {:.3f} seconds, slowest selection {:.3f} seconds'.format(
+            counts, time.time() - start, slowest))
+        return self.statuses
+
+    def predict_all(self):
+        futures = dict((self.io_executor.submit(self.predict, i, selection), i)
+                       for i, selection in self.selections.iterrows())
+        done, pending = wait(futures, timeout=self.timeout)
+        with self.lock:
+            self.cancelled.set()
+            saving = [future for future in pending if futures[future] in self.saving]
+        # Selections already saving finish, so no result is saved for a selection reported as timeout
+        done |= wait(saving)[0]
+        for future, i in futures.items():
+            if future not in done:
+                future.cancel()
+                continue
+            try:
+                future.result()
+                self.statuses[i].update({'status': 'ok', 'seconds': self.seconds[i]})
+            except Exception as e:
+                traceback.print_exc()
+                self.statuses[i].update({'status': 'failed', 'seconds': self.seconds[i], 'error': repr(e)})
+
+    # Runs on a file thread
+    def predict(self, i, selection):
+        start = time.time()
+        lock = keras_lock if self.uses_keras(selection) else None
+        try:
+            engine, histories = self.load(i, lock)
+            results = self.executor.submit(self.score, engine, histories, lock).result()
+            with self.lock:
+                if self.cancelled.is_set():
+                    return
+                self.saving.add(i)
+            for result in results:
+                new_result = pd.DataFrame([result], columns=['date', 'asset', 'label', 'score', 'prediction'])
+                save_result(result['asset'], result['label'], new_result)
+        finally:
+            self.seconds[i] = time.time() - start
+
+    # Models and newest rows of selection i, by an inference engine of the selection
+    def load(self, i, lock=None):
+        from app.inference import InferenceEngine
+        selection = self.selections.iloc[[i]]
+        with span('load_selection', asset=selection['asset'].iloc[0]):
+            if lock is None:
+                engine = InferenceEngine(selection, self.ensemble)
+            else:
+                with lock:
+                    engine = InferenceEngine(selection, self.ensemble)
+            return engine, engine.load_histories()
+
+    def score(self, engine, histories, lock=None):
+        if lock is None:
+            return engine.predict(histories)
+        with lock:
+            return engine.predict(histories)
+
+    # Whether a model of the selection (or a runner-up of an ensemble) is a keras model
+    def uses_keras(self, selection):
+        model_names = [selection['model_name']]
+        if self.ensemble and isinstance(selection.get('runner_ups'), str):
+            model_names += selection['runner_ups'].split(';')
+        return 'rnn' in model_names
+
+
+def save_result(asset, label_name, d):
+    from app.entry import save_prediction_result
+    save_prediction_result(asset, label_name, d)
+
+
+def run_predictions(selections, ensemble=False, timeout=prediction_timeout):
+    return PredictionPipeline(selections, ensemble, timeout=timeout).run()
@@ -0,0 +1,79 @@
+import atexit
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from app.constant import n_report_workers, max_pending_reports
+
+
+# Reports (csv files, PR curves) written by a bounded pool of background threads, off the training path.
+# submit blocks while max_pending writes are queued. flush waits for the submitted writes and raises the
+# first error.
+class ReportWriter(object):
+    def __init__(self, n_workers=n_report_workers, max_pending=max_pending_reports):
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.futures = []
+
+    def submit(self, func, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def flush(self):
+        with self.lock:
+            futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+
+writer = None
+writer_lock = threading.Lock()
+
+
+def get_writer():
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = ReportWriter()
+        return writer
+
+
+# func(*args, **kwargs) in the background, or inline without report workers
+def submit_report(func, *args, **kwargs):
+    if n_report_workers <= 0:
+        func(*args, **kwargs)
+        return None
+    return get_writer().submit(func, *args, **kwargs)
+
+
+# Waits for the submitted reports, e.g. before a worker process returns
+def flush_reports():
+    if writer is not None:
+        writer.flush()
+
+
+def close_reports():
+    try:
+        if writer is not None:
+            writer.close()
+    except Exception:
+        traceback.print_exc()
+
+
+atexit.register(close_reports)
@@ -0,0 +1,196 @@
+import math
+import time
+
+import numpy as np
+
+
+###############
+# Search space
+###############
+class Uniform(object):
+    def __init__(self, low, high, log=False, integer=False):
+        self.low, self.high, self.log, self.integer = low, high, log, integer
+
+    def sample(self, rng):
+        return self.from_unit(rng.uniform())
+
+    # Position in [0, 1], linear or logarithmic between low and high
+    def to_unit(self, value):
+        if self.log:
+            return (math.log(value) - math.log(self.low)) / (math.log(self.high) - math.log(self.low))
+        return (value - self.low) / float(self.high - self.low)
+
+    def from_unit(self, u):
+        u = min(max(float(u), 0.0), 1.0)
+        if self.log:
+            value = math.exp(math.log(self.low) + u * (math.log(self.high) - math.log(self.low)))
+        else:
+            value = self.low + u * (self.high - self.low)
+        return int(round(value)) if self.integer else value
+
+
+class Choice(object):
+    def __init__(self, values):
+        self.values = list(values)
+
+    def sample(self, rng):
+        return self.values[rng.randint(len(self.values))]
+
+
+def sample_config(space, rng):
+    return dict((name, dimension.sample(rng)) for name, dimension in sorted(space.items()))
+
+
+###############
+# Searchers
+###############
+# A searcher minimises objective(config, budget) -> (loss, info) over a search space, where budget is a number of
+# boosting rounds, epochs or iterations between min_budget and max_budget. search returns the best
+# (config, loss, info) at the largest budget evaluated. max_seconds stops starting new evaluations.
+class Searcher(object):
+    def __init__(self, max_seconds=None, seed=0):
+        self.max_seconds = max_seconds
+        self.seed = seed
+        self.history = []
+
+    def search(self, space, objective, min_budget, max_budget):
+        raise NotImplementedError
+
+    def start(self):
+        self.history = []
+        self.start_time = time.time()
+        self.rng = np.random.RandomState(self.seed)
+
+    def is_timeout(self):
+        return bool(self.history) and self.max_seconds is not None and \
+            time.time() - self.start_time > self.max_seconds
+
+    def evaluate(self, objective, config, budget):
+        loss, info = objective(config, budget)
+        self.history.append({'config': config, 'budget': budget, 'loss': loss, 'info': info})
+        return loss
+
+    # Settings that change the search result, for cache keys
+    def get_config(self):
+        config = dict((k, v) for k, v in vars(self).items() if k not in ['history', 'rng', 'start_time'])
+        config['searcher'] = type(self).__name__
+        return config
+
+    def get_best(self):
+        max_budget = max(h['budget'] for h in self.history)
+        best = min((h for h in self.history if h['budget'] == max_budget), key=lambda h: h['loss'])
+        print('{} search loss: {} of {} evaluations, config: {}'.format(
+            type(self).__name__, best['loss'], len(self.history), best['config']))
+        return best['config'], best['loss'], best['info']
+
+
+# n_config random configs at min_budget, keeping the best 1 / eta at eta times the budget until max_budget
+class SuccessiveHalving(Searcher):
+    def __init__(self, n_config=27, eta=3, max_seconds=None, seed=0):
+        super(SuccessiveHalving, self).__init__(max_seconds, seed)
+        self.n_config = n_config
+        self.eta = eta
+
+    def search(self, space, objective, min_budget, max_budget):
+        self.start()
+        configs = [sample_config(space, self.rng) for _ in range(self.n_config)]
+        self.halve(configs, objective, min_budget, max_budget)
+        return self.get_best()
+
+    def halve(self, configs, objective, budget, max_budget):
+        while configs and not self.is_timeout():
+            losses = []
+            for config in configs:
+                if self.is_timeout():
+                    break
+                losses.append(self.evaluate(objective, config, budget))
+            if budget >= max_budget:
+                break
+            n_keep = max(int(len(losses) / self.eta), 1)
+            configs = [configs[i] for i in np.argsort(losses)[:n_keep]]
+            budget = min(budget * self.eta, max_budget)
+
+
+# Successive halving brackets from many configs at a small budget to few configs at the full budget
+class Hyperband(SuccessiveHalving):
+    def search(self, space, objective, min_budget, max_budget):
+        self.start()
+        s_max = int(math.log(max_budget / float(min_budget)) / math.log(self.eta) + 1e-9)
+        for s in range(s_max, -1, -1):
+            n_config = int(math.ceil((s_max + 1) / float(s + 1) * self.eta ** s))
+            budget = max_budget / float(self.eta ** s)
+            configs = [sample_config(space, self.rng) for _ in range(n_config)]
+            self.halve(configs, objective, budget, max_budget)
+        return self.get_best()
+
+
+# Tree-structured Parzen estimator: after n_startup random configs, every trial evaluates the candidate with
+# the highest ratio of densities under the best gamma share of trials and under the rest
+class TPESearch(Searcher):
+    def __init__(self, n_trial=30, n_startup=10, n_candidate=24, gamma=0.25, max_seconds=None, seed=0):
+        super(TPESearch, self).__init__(max_seconds, seed)
+        self.n_trial, self.n_startup, self.n_candidate, self.gamma = n_trial, n_startup, n_candidate, gamma
+
+    def search(self, space, objective, min_budget, max_budget):
+        self.start()
+        for i in range(self.n_trial):
+            if self.is_timeout():
+                break
+            if i < self.n_startup:
+                config = sample_config(space, self.rng)
+            else:
+                config = self.suggest(space)
+            self.evaluate(objective, config, max_budget)
+        return self.get_best()
+
+    def suggest(self, space):
+        trials = sorted(self.history, key=lambda h: h['loss'])
+        n_good = max(int(math.ceil(self.gamma * len(trials))), 1)
+        good, bad = [t['config'] for t in trials[:n_good]], [t['config'] for t in trials[n_good:]]
+        candidates = [{} for _ in range(self.n_candidate)]
+        scores = np.zeros(self.n_candidate)
+        for name, dimension in sorted(space.items()):
+            if isinstance(dimension, Choice):
+                values = [dimension.values.index(c[name]) for c in good]
+                picks = [values[self.rng.randint(len(values))] for _ in candidates]
+                scores += np.log([get_choice_density(values, len(dimension.values))[p] for p in picks])
+                scores -= np.log([get_choice_density([dimension.values.index(c[name]) for c in bad],
+                                                     len(dimension.values))[p] for p in picks])
+                for candidate, p in zip(candidates, picks):
+                    candidate[name] = dimension.values[p]
+            else:
+                us, bad_us = [dimension.to_unit(c[name]) for c in good], [dimension.to_unit(c[name]) for c in bad]
+                bandwidth = max(np.std(us), 0.1)
+                picks = np.clip(self.rng.choice(us, self.n_candidate) + self.rng.randn(self.n_candidate) * bandwidth,
+                                0, 1)
+                scores += np.log(get_parzen_density(picks, us, bandwidth))
+                scores -= np.log(get_parzen_density(picks, bad_us, max(np.std(bad_us or [0]), 0.1)))
+                for candidate, u in zip(candidates, picks):
+                    candidate[name] = dimension.from_unit(u)
+        return candidates[int(np.argmax(scores))]
+
+
+# Mixture of gaussians at the observations and a uniform prior on [0, 1]
+def get_parzen_density(us, observations, bandwidth):
+    us = np.asarray(us)[:, np.newaxis]
+    observations = np.asarray(observations, dtype=float)[np.newaxis, :]
+    kernels = np.exp(-0.5 * ((us - observations) / bandwidth) ** 2) / (bandwidth * math.sqrt(2 * math.pi))
+    return (kernels.sum(axis=1) + 1.0) / (observations.shape[1] + 1)
+
+
+def get_choice_density(indices, n_value):
+    counts = np.bincount(indices, minlength=n_value).astype(float) if indices else np.zeros(n_value)
+    return (counts + 1) / (counts.sum() + n_value)
+
+
+searchers = {
+    'halving': SuccessiveHalving,
+    'hyperband': Hyperband,
+    'tpe': TPESearch,
+}
+
+
+def get_searcher(search, max_seconds=None):
+    if search is None or isinstance(search, Searcher):
+        return search
+    return searchers[search](max_seconds=max_seconds)
@@ -0,0 +1,152 @@
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+except ImportError:
+    # python 2.7
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import HTTPError, Request, urlopen
+
+from app.constant import model_cache_bytes, n_label
+from app.data import load_tail
+from app.entry import load_selection_result, get_selection_file_path
+from app.model import get_model
+
+# Feature rows per prediction, as in predict_selection
+n_history = 30
+
+
+# Loaded models by model path, least recently used first, within a budget of model file bytes
+class ModelCache(object):
+    def __init__(self, max_bytes=model_cache_bytes):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+
+    def get(self, selection, feature_names):
+        model_path = selection['model_path']
+        mtime = os.path.getmtime(model_path)
+        if model_path in self.models and self.models[model_path][1] == mtime:
+            # Reinserted as the most recently used
+            self.models[model_path] = self.models.pop(model_path)
+            return self.models[model_path][0]
+        model = get_model(selection['model_name'], target='classification', feature_names=feature_names)
+        model.load_model(model_path)
+        self.models[model_path] = (model, mtime, get_model_bytes(model_path))
+        while len(self.models) > 1 and sum(m[2] for m in self.models.values()) > self.max_bytes:
+            self.models.popitem(last=False)
+        return model
+
+
+def get_model_bytes(model_path):
+    paths = [p for p in [model_path, model_path + '.scaler'] if os.path.exists(p)]
+    return sum(os.path.getsize(p) for p in paths)
+
+
+# Warm models of selection.csv, reloaded when the selection file changes
+class PredictionService(object):
+    def __init__(self, max_bytes=model_cache_bytes):
+        self.cache = ModelCache(max_bytes)
+        self.selections = None
+        self.selection_mtime = None
+
+    def get_selections(self):
+        mtime = os.path.getmtime(get_selection_file_path())
+        if mtime != self.selection_mtime:
+            self.selections = load_selection_result()
+            self.selection_mtime = mtime
+        return self.selections
+
+    # rows: {asset: [[feature, ...], ...]} newest last, completed with stored history up to n_history rows.
+    # Assets without rows are predicted on stored data.
+    def predict(self, rows=None, assets=None):
+        rows = rows or {}
+        histories = {}
+        results = []
+        for _, selection in self.get_selections().iterrows():
+            asset, label_index = selection['asset'], int(selection['label_index'])
+            if assets and asset not in assets:
+                continue
+            if asset not in histories:
+                histories[asset] = get_history(asset, rows.get(asset))
+            xs, dates, feature_names = histories[asset]
+            model = self.cache.get(selection, feature_names)
+            scores, predictions = model.predict(xs, selection['threshold'])
+            results.append({'asset': asset, 'label_index': label_index, 'model_name': selection['model_name'],
+                            'date': dates[-1], 'score': float(scores[-1]), 'prediction': int(predictions[-1])})
+        return results
+
+
+def get_history(asset, rows=None):
+    d = load_tail(asset, n_history, is_prediction=True)
+    feature_names = list(d.columns[:-n_label])
+    xs = d.values[:, :-n_label]
+    dates = list(d.index)
+    if rows:
+        rows = np.array(rows, dtype=xs.dtype)
+        if rows.ndim != 2 or rows.shape[1] != xs.shape[1]:
+            raise ValueError('{} rows need {} features'.format(asset, xs.shape[1]))
+        xs = np.concatenate([xs, rows])[-n_history:]
+        dates = (dates + ['request'] * len(rows))[-n_history:]
+    return xs, dates, feature_names
+
+
+###############
+# HTTP
+###############
+class PredictionHandler(BaseHTTPRequestHandler):
+    service = None
+
+    # POST /predict {"rows": {asset: [[feature, ...], ...]}, "assets": [asset, ...]}
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            body = {'predictions': self.service.predict(request.get('rows'), request.get('assets'))}
+            status = 200
+        except Exception as e:
+            body, status = {'error': repr(e)}, 500
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# Requests are served one at a time so keras models are used from a single thread
+def serve(host='127.0.0.1', port=8050, max_bytes=model_cache_bytes):
+    PredictionHandler.service = PredictionService(max_bytes)
+    server = HTTPServer((host, port), PredictionHandler)
+    print('prediction server on {}:{}'.format(host, port))
+    server.serve_forever()
+
+
+class PredictionClient(object):
+    def __init__(self, url='http://127.0.0.1:8050'):
+        self.url = url
+
+    def predict(self, rows=None, assets=None):
+        data = json.dumps({'rows': rows or {}, 'assets': assets}).encode('utf-8')
+        request = Request(self.url + '/predict', data=data, headers={'Content-Type': 'application/json'})
+        try:
+            response = urlopen(request).read()
+        except HTTPError as e:
+            response = e.read()
+        response = json.loads(response.decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['predictions']
+
+
+# python -m app.server [port]
+if __name__ == '__main__':
+    serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8050)
@@ -1,66 +1,93 @@
 import copy
 import math
 import os
+import time
 from itertools import product
 
 import numpy as np
 import pandas as pd
 import xgboost as xgb
-from keras.callbacks import EarlyStopping
 from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error, roc_auc_score, accuracy_score, f1_score, precision_score, \
-    recall_score
+from sklearn.metrics import mean_squared_error, log_loss
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 
 from app.model import get_xgb_classification_params, get_xgb_regression_params, get_rnn_model, get_rnn_data, \
-    xgb_param_selection, get_model, get_model_file_path, search_threshold
-from app.data import load_data, get_classification_data
+    xgb_param_selection, get_model, get_model_file_path, search_threshold, get_best_weights_callback, \
+    get_thread_params
+from app.cache import get_artifact_key, load_artifact, save_artifact
+from app.constant import artifact_cache_bytes, dtype_policy, target_assets
+from app.data import load_data, get_classification_data, get_labels, get_dtypes
+from app.metric import get_decay_weights, evaluate_classification
+from app.report import submit_report
+from app.timing import span, tagged
 
 rnn_length = 20
 batch_size = 128
 n_label = 3
+# Sequential simulation grid
+decay_ratios = [0.99, 0.995, 0.997, 1]
+n_batch_predictions = [5, 10, 20, 60, 120, 240, 480]
+sequential_fields = ['label', 'n_train', 'n_test', 'decay_ratio', 'n_batch_prediction', 'auc', 'accuracy', 'f1',
+                     'precision', 'recall', 'incremental', 'seconds', 'n_search']
 
 
+# Classification, regression and sequential grids of the target assets, on the sweep worker pool, and the
+# incremental sequential simulation against full retraining
 def main():
-    test_size = 200
-    asset = 'hsi3'
-    d = load_data(asset, is_prediction=False)
+    from app.sweep import run_sweep
+    for name in ['classification', 'regression', 'sequential']:
+        run_sweep(name)
+    for asset in target_assets:
+        compare_sequential(asset, load_data(asset))
 
-    # Classification
-    classification(asset, d, test_size)
 
-    # Regression
-    regression(asset, d, test_size)
-
-    # Sequential
-    sequential(asset, d, test_size)
-
-
-def regression(asset, d, test_size):
+def regression(asset, d, test_size=200, dtype_policy=dtype_policy):
+    from keras.callbacks import EarlyStopping
     # Report
     fields = ['label', 'n_train', 'n_test', 'model', 'train_loss', 'feature_importance', 'rmse']
     results = []
 
-    # Data
+    # Data, shared by the labels: features, their split, the xgboost features, and the scaled rnn windows of one
+    # rnn with an output per label
     feature_index = d.shape[1] - n_label
     feature_names = d.columns[:feature_index]
     n_feature = len(feature_names)
-    xs = d.iloc[:, :feature_index]
+    feature_dtype = get_dtypes(dtype_policy)[0]
+    xs = d.iloc[:, :feature_index].values.astype(feature_dtype, copy=False)
+    label_ys = d.iloc[:, [-i for i in range(1, n_label + 1)]].values.astype(feature_dtype, copy=False)
+    train_xs, test_xs = xs[:-test_size], xs[-test_size:]
+    train_label_ys, test_label_ys = label_ys[:-test_size], label_ys[-test_size:]
+    d_train = xgb.DMatrix(train_xs, feature_names=list(feature_names))
+    d_test = xgb.DMatrix(test_xs, feature_names=list(feature_names))
+
+    # Normalized by training data
+    scaler = StandardScaler().fit(train_xs)
+    sequence_xs, sequence_ys = get_rnn_data(scaler.transform(xs).astype(feature_dtype, copy=False), label_ys,
+                                            rnn_length)
+    rnn_train_xs, rnn_test_xs = sequence_xs[:-test_size], sequence_xs[-test_size:]
+    rnn_train_ys, rnn_test_ys = sequence_ys[:-test_size], sequence_ys[-test_size:]
+    rnn_model = get_rnn_model(rnn_length, n_feature, target='regression', n_output=n_label)
+    early_stopping = EarlyStopping(patience=30, monitor='val_loss')
+    best_weights, _ = get_best_weights_callback(rnn_model)
+    history = rnn_model.fit(rnn_train_xs, rnn_train_ys, batch_size=batch_size, epochs=1000, validation_split=1.0 / 5,
+                            callbacks=[early_stopping, best_weights], shuffle=False)
+    # print('RNN training history', history.history)
+    rnn_train_predictions = rnn_model.predict(rnn_train_xs)
+    rnn_predictions = rnn_model.predict(rnn_test_xs)
+
     # Evaluate labels
     for label_index in range(1, n_label + 1, 1):
         label_name = d.columns[-label_index]
-        ys = list(d.iloc[:, -label_index])
-        train_xs, test_xs, train_ys, test_ys = train_test_split(xs, ys, shuffle=False, test_size=test_size)
+        train_ys, test_ys = train_label_ys[:, label_index - 1], test_label_ys[:, label_index - 1]
         attributes = [label_name, len(train_ys), len(test_ys)]
 
         # Evaluate models
         for model_name in ['gbdt', 'lr', 'rnn']:
             if model_name == 'gbdt':
                 # Model - xgboost
-                params = get_xgb_regression_params()
-                d_train = xgb.DMatrix(train_xs, label=train_ys, feature_names=feature_names)
-                d_test = xgb.DMatrix(test_xs, label=test_ys, feature_names=feature_names)
+                params = get_thread_params(get_xgb_regression_params())
+                d_train.set_label(train_ys)
                 best_param, best_round = xgb_param_selection(params, d_train, target='test-rmse-mean')
                 model = xgb.train(best_param, d_train, num_boost_round=best_round, verbose_eval=False)
                 train_result = model.eval(d_train)
@@ -75,25 +102,11 @@ def regression(asset, d, test_size):
                 predictions = model.predict(test_xs)
                 feature_importance = None
             elif model_name == 'rnn':
-                # Normalized by training data
-                scaler = StandardScaler().fit(train_xs)
-                norm_xs = scaler.transform(xs)
-                sequnce_xs, sequence_ys = get_rnn_data(norm_xs, ys, rnn_length)
-
-                # Data
-                train_xs, test_xs, train_ys, test_ys = train_test_split(sequnce_xs, sequence_ys, shuffle=False,
-                                                                        test_size=test_size)
-                model = get_rnn_model(rnn_length, n_feature, target='regression')
-                early_stopping = EarlyStopping(patience=30, monitor='val_loss')
-                history = model.fit(train_xs, train_ys, batch_size=batch_size, epochs=1000, validation_split=1.0 / 5,
-                                    callbacks=[early_stopping], shuffle=False)
-                best_epoch = np.argmin(history.history['val_loss'])
-                model = get_rnn_model(rnn_length, n_feature, target='regression')
-                model.fit(train_xs, train_ys, batch_size=batch_size, epochs=best_epoch)
-                train_loss = model.evaluate(train_xs, train_ys)[0]
-                predictions = model.predict(test_xs)
+                train_loss = mean_squared_error(rnn_train_ys[:, label_index - 1],
+                                                rnn_train_predictions[:, label_index - 1])
+                test_ys = rnn_test_ys[:, label_index - 1]
+                predictions = rnn_predictions[:, label_index - 1]
                 feature_importance = None
-                # print('RNN training history', history.history)
 
             # Evaluation
             mse = mean_squared_error(test_ys, predictions)
@@ -103,17 +116,65 @@ def regression(asset, d, test_size):
             result = attributes + performance
             results.append(result)
     report = pd.DataFrame(results, columns=fields)
-    report.to_csv(get_regression_file_path(asset), index=False)
+    submit_report(report.to_csv, get_regression_file_path(asset), index=False)
     print(report)
+    return report
 
 
-def classification(asset, d, test_size=200, model_names=['gbdt', 'lr', 'rnn'], label_index=-1, is_production=False):
-    fields = ['asset', 'label', 'label_index', 'n_train', 'n_train_pos', 'n_test', 'n_test_pos', 'model_name', 'train_loss',
-              'feature_importance', 'auc', 'accuracy', 'precision', 'recall', 'f1', 'threshold']
+# is_production saves the selected model and, with save_runner_ups, the other models for ensembles
+def classification(asset, d, test_size=200, model_names=['gbdt', 'lr', 'rnn'], label_index=-1, is_production=False,
+                   save_runner_ups=True, dtype_policy=dtype_policy):
     # Data
-    xs, ys, feature_names, label_name = get_classification_data(d, label_index)
+    xs, ys, feature_names, label_name = get_classification_data(d, label_index, dtype_policy)
     train_xs, test_xs, train_ys, test_ys = train_test_split(xs, ys, shuffle=False, test_size=test_size)
-    n_train_pos, n_train, n_test_pos, n_test = sum(train_ys), len(train_ys), sum(test_ys), len(test_ys)
+    return classify(asset, label_name, label_index, train_xs, test_xs, train_ys, test_ys, feature_names, test_size,
+                    model_names, is_production, save_runner_ups)
+
+
+# All labels of an asset in one pass: the features and their train/test split are shared, and the rnn is one
+# model with a sigmoid output per label, trained once on shared scaling and windows. Returns the best
+# performance of every label index.
+def multi_label_classification(asset, d, test_size=200, model_names=['gbdt', 'lr', 'rnn'], label_indices=[-1],
+                               is_production=False, save_runner_ups=True, dtype_policy=dtype_policy):
+    feature_index = d.shape[1] - n_label
+    feature_names = d.columns[:feature_index]
+    values = np.asarray(d.values)
+    xs = values[:, :feature_index].astype(get_dtypes(dtype_policy)[0], copy=False)
+    label_values = values[:, label_indices]
+    train_xs, test_xs = xs[:-test_size], xs[-test_size:]
+    train_label_values, test_label_values = label_values[:-test_size], label_values[-test_size:]
+    train_label_ys = get_labels(train_label_values, dtype_policy)
+
+    trained_models = dict((label_index, {}) for label_index in label_indices)
+    if 'rnn' in model_names:
+        model = get_model('rnn', 'classification', feature_names=feature_names, n_output=len(label_indices))
+        with tagged(asset=asset, model_name='rnn'):
+            key = get_artifact_key(model, train_xs, train_label_ys, test_size) if artifact_cache_bytes else None
+            if not key or load_artifact(key, model) is None:
+                with span('train'):
+                    status = model.train(train_xs, train_label_ys)
+                if key:
+                    save_artifact(key, model, {'status': status})
+        for i, label_index in enumerate(label_indices):
+            trained_models[label_index]['rnn'] = model.get_output_model(i)
+
+    best_performances = []
+    for i, label_index in enumerate(label_indices):
+        best_performances.append(classify(asset, d.columns[label_index], label_index, train_xs, test_xs,
+                                          get_labels(train_label_values[:, i], dtype_policy),
+                                          get_labels(test_label_values[:, i], dtype_policy), feature_names,
+                                          test_size, model_names, is_production, save_runner_ups,
+                                          trained_models[label_index]))
+    return best_performances
+
+
+# Trains, evaluates and selects the models of one label. trained_models: models by name already trained on the
+# label, e.g. outputs of a multi-output model
+def classify(asset, label_name, label_index, train_xs, test_xs, train_ys, test_ys, feature_names, test_size=200,
+             model_names=['gbdt', 'lr', 'rnn'], is_production=False, save_runner_ups=True, trained_models={}):
+    fields = ['asset', 'label', 'label_index', 'n_train', 'n_train_pos', 'n_test', 'n_test_pos', 'model_name', 'train_loss',
+              'feature_importance', 'auc', 'accuracy', 'precision', 'recall', 'f1', 'threshold']
+    n_train_pos, n_train, n_test_pos, n_test = int(np.sum(train_ys)), len(train_ys), int(np.sum(test_ys)), len(test_ys)
     attributes = {'asset': asset, 'label': label_name, 'label_index': label_index, 'n_train': n_train, 'n_train_pos': n_train_pos,
                   'n_test': n_test, 'n_test_pos': n_test_pos}
 
@@ -121,17 +182,38 @@ def classification(asset, d, test_size=200, model_names=['gbdt', 'lr', 'rnn'], l
     results = []
     models = []
     aucs = []
+    test_scores = []
     for model_name in model_names:
-        model = get_model(model_name, 'classification', feature_names=feature_names)
+        model = trained_models.get(model_name) or get_model(model_name, 'classification', feature_names=feature_names)
         models.append(model)
-        status = model.train(train_xs, train_ys)
-        feature_importance = model.get_feature_importance()
-        threshold = search_threshold(train_xs, train_ys, model, valid_size=test_size)
-        scores, predictions = model.predict(test_xs)
+        with tagged(asset=asset, label=label_name, model_name=model_name):
+            # Unchanged training data and model config reuse the trained model and its threshold
+            key = get_artifact_key(model, train_xs, train_ys, test_size) \
+                if artifact_cache_bytes and model_name not in trained_models else None
+            artifact = load_artifact(key, model) if key else None
+            if model_name in trained_models:
+                status = model.status
+                feature_importance = model.get_feature_importance()
+                threshold = search_threshold(train_xs, train_ys, model, valid_size=test_size)
+            elif artifact is None:
+                with span('train'):
+                    status = model.train(train_xs, train_ys)
+                feature_importance = model.get_feature_importance()
+                threshold = search_threshold(train_xs, train_ys, model, valid_size=test_size)
+                if key:
+                    save_artifact(key, model, {'status': status, 'threshold': threshold,
+                                               'feature_importance': feature_importance})
+            else:
+                status, threshold = artifact['status'], artifact['threshold']
+                feature_importance = artifact['feature_importance']
+                if feature_importance is not None:
+                    feature_importance = [tuple(item) for item in feature_importance]
+            scores, predictions = model.predict(test_xs)
         print('threshold', threshold, 'avg_score', np.average(scores))
         # print(sorted(list(zip(scores, test_ys)), reverse=True))
-        performance = model.test(test_xs, test_ys, threshold)
+        performance = model.evaluate(model.get_test_labels(test_ys), (scores > threshold).astype(int), scores)
         aucs.append(performance['auc'])
+        test_scores.append(scores)
 
         result = copy.deepcopy(attributes)
         result.update(performance)
@@ -139,98 +221,161 @@ def classification(asset, d, test_size=200, model_names=['gbdt', 'lr', 'rnn'], l
         result.update({'feature_importance': feature_importance, 'model_name': model_name, 'threshold': threshold})
         results.append(result)
     report = pd.DataFrame(results, columns=fields)
-    report.to_csv(get_classification_file_path(asset, label_name, is_production), index=False)
+    submit_report(report.to_csv, get_classification_file_path(asset, label_name, is_production), index=False)
 
-    # Selection
-    index = np.argmax(aucs)
+    # Selection, by auc of the models with one (NaN when the test labels have a single class)
+    index = 0 if np.all(np.isnan(aucs)) else int(np.nanargmax(aucs))
     best_performance = report.iloc[index, :]
     if is_production:
         model_name = model_names[index]
         model_path = get_model_file_path(asset, label_name, model_name)
         model = models[index]
-        model.save_model(model_path)
-        model.save_pr_curve(asset, label_name, test_xs, test_ys)
+        with span('save_model', asset=asset, label=label_name, model_name=model_name):
+            model.save_model(model_path)
+        model.save_pr_curve(asset, label_name, test_xs, test_ys, test_scores[index])
         best_performance['model_path'] = model_path
+        if save_runner_ups:
+            # Other models by auc, with their thresholds
+            runner_ups = [i for i in np.argsort(aucs)[::-1] if i != index]
+            for i in runner_ups:
+                with span('save_model', asset=asset, label=label_name, model_name=model_names[i]):
+                    models[i].save_model(get_model_file_path(asset, label_name, model_names[i]))
+            best_performance['runner_ups'] = ';'.join(model_names[i] for i in runner_ups)
+            best_performance['runner_up_thresholds'] = ';'.join(str(report['threshold'][i]) for i in runner_ups)
     return best_performance
 
 
 
 
-def sequential(asset, d, test_size=200):
+def sequential(asset, d, test_size=200, incremental=False, dtype_policy=dtype_policy):
     # Regression and Classification
     results = []
-    fields = ['label', 'n_train', 'n_test', 'decay_ratio', 'n_batch_prediction', 'auc', 'accuracy', 'precision',
-              'recall', 'f1']
     # Data
     feature_index = d.shape[1] - n_label
     feature_names = d.columns[:feature_index]
     n_train = d.shape[0] - test_size
-    n_test = test_size
-    decay_ratios = [0.99, 0.995, 0.997, 1]
-    n_batch_predictions = [5, 10, 20, 60, 120, 240, 480]
     # decay_ratio = 0.997
     # n_batch_prediction = 20
-    xs = d.iloc[:, :feature_index].values
+    xs = d.iloc[:, :feature_index].values.astype(get_dtypes(dtype_policy)[0], copy=False)
+    # Features are shared by the labels
+    d_all = xgb.DMatrix(xs, feature_names=feature_names)
 
     # Evaluate labels
     for label_index in range(1, n_label + 1, 1):
-        for decay_ratio, n_batch_prediction in product(decay_ratios, n_batch_predictions):
-            label_name = d.columns[-label_index]
-            # ys_reg = d.iloc[:, -label_index]
-            ys_class = list((d.iloc[:, -label_index] > 0).astype(int))
-            ys = ys_class
-            train_ys, test_ys = ys[:n_train], ys[n_train:]
-
-            predictions = []
-            scores = []
-
-            # Sequential batch simulation
-            n_batch = int(math.ceil(test_size / float(n_batch_prediction)))
-            for i in range(n_batch):
-                print('Predict batch {}/{}'.format(i + 1, n_batch))
-                batch_train_index = n_train + n_batch_prediction * i
-                batch_test_index = batch_train_index + n_batch_prediction
-                batch_train_xs, batch_train_ys = xs[:batch_train_index, :], ys[:batch_train_index]
-                batch_train_weights = get_weights(batch_train_ys, decay_ratio)
-                batch_test_xs, batch_test_ys = xs[batch_train_index:batch_test_index, :], ys[
-                                                                                          batch_train_index:batch_test_index]
-
-                params = get_xgb_classification_params()
-                batch_d_train = xgb.DMatrix(batch_train_xs, label=batch_train_ys, feature_names=feature_names,
-                                            weight=batch_train_weights)
-                batch_d_test = xgb.DMatrix(batch_test_xs, label=batch_test_ys, feature_names=feature_names)
+        label_name = d.columns[-label_index]
+        # ys_reg = d.iloc[:, -label_index]
+        ys_class = get_labels(d.iloc[:, -label_index].values, dtype_policy)
+        ys = ys_class
+        train_ys, test_ys = ys[:n_train], ys[n_train:]
+        d_all.set_label(ys)
+
+        label_results = {}
+        for n_batch_prediction in n_batch_predictions:
+            walks = walk_forward(d_all, n_train, test_size, n_batch_prediction, decay_ratios, incremental)
+            label_results[n_batch_prediction] = get_sequential_results(
+                label_name, n_train, test_ys, n_batch_prediction, decay_ratios, walks, incremental)
+        for i, n_batch_prediction in product(range(len(decay_ratios)), n_batch_predictions):
+            results.append(label_results[n_batch_prediction][i])
+
+    report = pd.DataFrame(results, columns=sequential_fields)
+    submit_report(report.to_csv, get_sequential_file_path(asset, suffix='_incremental' if incremental else ''), index=False)
+    return report
+
+
+# One cell of the sequential grid: the walk-forward simulation of a label and batch size for all decay ratios,
+# as sequential report rows
+def sequential_cell(d, label_index, n_batch_prediction, test_size=200, decay_ratios=decay_ratios, incremental=False,
+                    dtype_policy=dtype_policy):
+    feature_index = d.shape[1] - n_label
+    feature_names = d.columns[:feature_index]
+    n_train = d.shape[0] - test_size
+    xs = np.asarray(d.values)[:, :feature_index].astype(get_dtypes(dtype_policy)[0], copy=False)
+    ys = get_labels(np.asarray(d.values)[:, label_index], dtype_policy)
+    d_all = xgb.DMatrix(xs, label=ys, feature_names=feature_names)
+    walks = walk_forward(d_all, n_train, test_size, n_batch_prediction, decay_ratios, incremental)
+    return get_sequential_results(d.columns[label_index], n_train, ys[n_train:], n_batch_prediction, decay_ratios,
+                                  walks, incremental)
+
+
+# Report rows of the walks of a batch size, one per decay ratio. All decay ratios are evaluated at once.
+def get_sequential_results(label_name, n_train, test_ys, n_batch_prediction, decay_ratios, walks, incremental):
+    scores = np.array([walks[decay_ratio]['scores'] for decay_ratio in decay_ratios])
+    predictions = np.array([walks[decay_ratio]['predictions'] for decay_ratio in decay_ratios])
+    performance = evaluate_classification(test_ys, predictions, scores)
+    results = []
+    for i, decay_ratio in enumerate(decay_ratios):
+        walk = walks[decay_ratio]
+        results.append([label_name, n_train, len(test_ys), decay_ratio, n_batch_prediction] +
+                       [performance[metric][i] for metric in ['auc', 'accuracy', 'f1', 'precision', 'recall']] +
+                       [incremental, walk['seconds'], walk['n_search']])
+    return results
+
+
+# Sequential batch simulation of the test rows with one booster per decay ratio. Decay ratios share the batch
+# training DMatrix and only change its weights. Full retrain (the default) searches params and trains from scratch
+# every batch; incremental continues boosting the previous booster with its params, until the loss on the last
+# predicted batch drifts above drift_ratio times the mean loss since the last search.
+def walk_forward(d_all, n_train, test_size, n_batch_prediction, decay_ratios, incremental=False, drift_ratio=1.2):
+    params = get_thread_params(get_xgb_classification_params())
+    ys = d_all.get_label()
+    walks = dict((decay_ratio, {'scores': np.zeros(0), 'predictions': np.zeros(0, dtype=int), 'seconds': 0.0,
+                                'n_search': 0, 'model': None, 'param': None, 'round': None, 'losses': []})
+                 for decay_ratio in decay_ratios)
+    n_batch = int(math.ceil(test_size / float(n_batch_prediction)))
+    for i in range(n_batch):
+        print('Predict batch {}/{}'.format(i + 1, n_batch))
+        start = time.time()
+        batch_train_index = n_train + n_batch_prediction * i
+        batch_test_index = min(batch_train_index + n_batch_prediction, n_train + test_size)
+        batch_d_train = d_all.slice(list(range(batch_train_index)))
+        batch_d_test = d_all.slice(list(range(batch_train_index, batch_test_index)))
+        batch_weights = get_decay_weights(batch_train_index, decay_ratios)
+        shared_seconds = (time.time() - start) / len(decay_ratios)
+
+        for j, decay_ratio in enumerate(decay_ratios):
+            start = time.time()
+            walk = walks[decay_ratio]
+            batch_d_train.set_weight(batch_weights[j])
+            is_drift = False
+            if incremental and walk['model'] is not None:
+                last_index = batch_train_index - n_batch_prediction
+                walk['losses'].append(log_loss(ys[last_index:batch_train_index], walk['scores'][-n_batch_prediction:],
+                                               labels=[0, 1]))
+                is_drift = walk['losses'][-1] > drift_ratio * np.mean(walk['losses'])
+
+            if not incremental or walk['model'] is None or is_drift:
                 best_param, best_round = xgb_param_selection(params, batch_d_train, target='test-logloss-mean')
-
                 model = xgb.train(best_param, batch_d_train, num_boost_round=best_round, verbose_eval=False)
-                batch_scores = model.predict(batch_d_test)
-                batch_predictions = (np.array(batch_scores) > 0.5).astype(int)
-                scores += list(batch_scores)
-                predictions += list(batch_predictions)
-
-            performance = evaluate_classification(scores, predictions, test_ys)
-            result = [label_name, n_train, n_test, decay_ratio, n_batch_prediction] + performance
-            results.append(result)
-
-    report = pd.DataFrame(results, columns=fields)
-    report.to_csv(get_sequential_file_path(asset), index=False)
-    return
-
-
-def get_weights(ys, decay_ratio=0.995):
-    weights = list(reversed([math.pow(decay_ratio, i) for i in range(len(ys))]))
-    return weights
-
-
-def evaluate_classification(scores, predictions, gts):
-    if not scores:
-        auc = None
-    else:
-        auc = roc_auc_score(gts, scores)
-    acc = accuracy_score(gts, predictions)
-    f1 = f1_score(gts, predictions)
-    precision = precision_score(gts, predictions)
-    recall = recall_score(gts, predictions)
-    return auc, acc, f1, precision, recall
+                walk.update({'param': best_param, 'round': best_round, 'losses': []})
+                walk['n_search'] += 1
+            else:
+                # Boost for the share of new rows in the training data
+                n_round = int(math.ceil(walk['round'] * n_batch_prediction / float(batch_train_index)))
+                model = xgb.train(walk['param'], batch_d_train, num_boost_round=n_round, xgb_model=walk['model'],
+                                  verbose_eval=False)
+            walk['model'] = model
+
+            batch_scores = model.predict(batch_d_test)
+            batch_predictions = (batch_scores > 0.5).astype(int)
+            walk['scores'] = np.concatenate([walk['scores'], batch_scores])
+            walk['predictions'] = np.concatenate([walk['predictions'], batch_predictions])
+            walk['seconds'] += time.time() - start + shared_seconds
+    return walks
+
+
+# Run the full retrain and the incremental simulation: speedup and metric deltas of incremental
+def compare_sequential(asset, d, test_size=200, dtype_policy=dtype_policy):
+    full = sequential(asset, d, test_size, incremental=False, dtype_policy=dtype_policy)
+    report = sequential(asset, d, test_size, incremental=True, dtype_policy=dtype_policy)
+    report = report.merge(full, on=['label', 'n_train', 'n_test', 'decay_ratio', 'n_batch_prediction'],
+                          suffixes=('', '_full'))
+    report['speedup'] = report['seconds_full'] / report['seconds']
+    for metric in ['auc', 'accuracy', 'f1', 'precision', 'recall']:
+        report[metric + '_delta'] = report[metric] - report[metric + '_full']
+    submit_report(report.to_csv, get_sequential_file_path(asset, suffix='_comparison'), index=False)
+    print('sequential speedup {}, auc delta {}'.format(report['seconds_full'].sum() / report['seconds'].sum(),
+                                                      report['auc_delta'].mean()))
+    return report
 
 
 ###############
@@ -252,12 +397,12 @@ def get_classification_file_path(asset, label_name, is_production=False):
     return os.path.join(path, '{}_{}_classification.csv'.format(asset, label_name))
 
 
-def get_sequential_file_path(asset, is_production=False):
+def get_sequential_file_path(asset, is_production=False, suffix=''):
     if is_production:
         path = 'output/report'
     else:
         path = 'output/exp'
-    return os.path.join(path, '{}_sequential.csv'.format(asset))
+    return os.path.join(path, '{}_sequential{}.csv'.format(asset, suffix))
 
 
 
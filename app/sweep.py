@@ -0,0 +1,170 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+
+import pandas as pd
+
+from app.constant import target_assets, n_label, dtype_policy, n_sweep_workers, n_sweep_threads
+from app.data import load_data, load_store, get_dtypes
+from app.model import limit_threads, get_worker_threads
+from app.report import flush_reports
+from app.timing import span
+
+
+###############
+# Grids
+###############
+# Cells of a grid: every combination of its values, e.g. {'asset': ['HSI'], 'label_index': [-1, -2]}
+def expand_grid(grid):
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in product(*[grid[name] for name in names])]
+
+
+def get_grid(name, assets=target_assets):
+    from app.simulation import n_batch_predictions
+    label_indices = [-i for i in range(1, n_label + 1)]
+    grids = {
+        'classification': {'asset': assets, 'label_index': label_indices},
+        'regression': {'asset': assets},
+        'sequential': {'asset': assets, 'label_index': label_indices, 'n_batch_prediction': n_batch_predictions},
+    }
+    return grids[name]
+
+
+###############
+# Cells
+###############
+# A cell runs one simulation with the cell values and fixed params as keyword arguments and returns report rows.
+# Rows carry the cell values, which mark the cell as done in the sweep report.
+def run_classification(asset, label_index, dtype_policy=dtype_policy, **kwargs):
+    from app.simulation import classification
+    d = get_data(asset, dtype_policy)
+    return [classification(asset, d, label_index=label_index, dtype_policy=dtype_policy, **kwargs).to_dict()]
+
+
+def run_regression(asset, dtype_policy=dtype_policy, **kwargs):
+    from app.simulation import regression
+    report = regression(asset, get_data(asset, dtype_policy), dtype_policy=dtype_policy, **kwargs)
+    return report.to_dict('records')
+
+
+def run_sequential(asset, label_index, n_batch_prediction, dtype_policy=dtype_policy, **kwargs):
+    from app.simulation import sequential_cell, sequential_fields
+    rows = sequential_cell(get_data(asset, dtype_policy), label_index, n_batch_prediction,
+                           dtype_policy=dtype_policy, **kwargs)
+    return [dict(zip(sequential_fields, row)) for row in rows]
+
+
+sweeps = {
+    'classification': run_classification,
+    'regression': run_regression,
+    'sequential': run_sequential,
+}
+
+# Data loaded by this process: (asset, dtype_policy) -> data frame over the memory mapped store
+data_frames = {}
+
+
+# Workers read the stores memory mapped, so the pages of an asset are shared by all workers instead of copied
+# into every task
+def get_data(asset, dtype_policy=dtype_policy):
+    if (asset, dtype_policy) not in data_frames:
+        data_frames[asset, dtype_policy] = load_data(asset, is_prediction=False, dtype_policy=dtype_policy)
+    return data_frames[asset, dtype_policy]
+
+
+def run_cell(name, cell, params, n_threads=None):
+    if n_threads:
+        limit_threads(n_threads)
+    with span('sweep_cell', sweep=name, **cell):
+        try:
+            rows = sweeps[name](**dict(params, **cell))
+        finally:
+            # Worker processes exit without atexit handlers
+            flush_reports()
+    for row in rows:
+        row.update(cell)
+    return rows
+
+
+###############
+# Runner
+###############
+# Runs the cells of a sweep (a simulation name) over grid (default: get_grid(name)) with params as fixed keyword
+# arguments, on n_workers processes. Every finished cell is appended to the sweep report, and cells already
+# in the report are skipped, so an interrupted sweep resumes where it stopped. Returns the report and the
+# failed cells. n_threads only limits the threads of worker processes, a serial sweep keeps all of them.
+def run_sweep(name, grid=None, params=None, n_workers=n_sweep_workers, n_threads=n_sweep_threads,
+              file_path=None):
+    grid = grid or get_grid(name)
+    params = params or {}
+    file_path = file_path or get_sweep_file_path(name)
+    done = get_done_cells(file_path, sorted(grid))
+    cells = [cell for cell in expand_grid(grid) if get_cell_key(cell, sorted(grid)) not in done]
+    print('sweep {}: {} cells, {} done'.format(name, len(cells) + len(done), len(done)))
+
+    # Stores are built once here rather than by every worker
+    for asset in sorted(set(cell['asset'] for cell in cells if 'asset' in cell)):
+        load_store(asset, get_dtypes(params.get('dtype_policy', dtype_policy))[0])
+
+    failed_cells = []
+    if n_workers <= 1:
+        for cell in cells:
+            try:
+                save_sweep_rows(file_path, run_cell(name, cell, params))
+            except Exception:
+                traceback.print_exc()
+                failed_cells.append(cell)
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        n_threads = get_worker_threads(n_workers, n_threads)
+        futures = dict((executor.submit(run_cell, name, cell, params, n_threads), i) for i, cell in enumerate(cells))
+        for future in as_completed(futures):
+            try:
+                save_sweep_rows(file_path, future.result())
+            except Exception:
+                traceback.print_exc()
+                failed_cells.append(cells[futures[future]])
+        executor.shutdown(wait=True)
+    if failed_cells:
+        print('failed cells: {}'.format(failed_cells))
+    report = pd.read_csv(file_path) if os.path.exists(file_path) else pd.DataFrame()
+    return report, failed_cells
+
+
+def get_cell_key(cell, names):
+    return tuple(str(cell[name]) for name in names)
+
+
+# Keys of the cells with rows in the sweep report
+def get_done_cells(file_path, names):
+    if not os.path.exists(file_path):
+        return set()
+    report = pd.read_csv(file_path, dtype=str)
+    if report.empty or not set(names) <= set(report.columns):
+        return set()
+    return set(tuple(values) for values in report[names].values)
+
+
+# The rows of a cell in one write, in the column order of the report
+def save_sweep_rows(file_path, rows):
+    if not rows:
+        return
+    if not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    d = pd.DataFrame(rows)
+    if os.path.exists(file_path) and os.path.getsize(file_path):
+        columns = list(pd.read_csv(file_path, nrows=0).columns)
+        text = d.reindex(columns=columns).to_csv(header=False, index=False)
+    else:
+        text = d.to_csv(index=False)
+    with open(file_path, 'a') as f:
+        f.write(text)
+
+
+###############
+# IO
+###############
+def get_sweep_file_path(name):
+    return os.path.join('output/exp', '{}_sweep.csv'.format(name))
@@ -0,0 +1,209 @@
+import atexit
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from app.constant import trace_path, profile_stages, profiler
+
+# Spans are only timed when a trace file or profiled stages are configured, otherwise span and timed
+# cost one flag check
+enabled = False
+lock = threading.Lock()
+context = threading.local()
+# (name, sorted tags) -> [count, seconds]
+totals = defaultdict(lambda: [0, 0.0])
+profile_counts = defaultdict(int)
+
+
+def enable(path=trace_path, stages=profile_stages, profiler_name=profiler):
+    global enabled, trace_path, profile_stages, profiler
+    trace_path, profile_stages, profiler = path, list(stages), profiler_name
+    enabled = bool(trace_path or profile_stages)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+# Tags (asset, label, model_name, ...) added to every span opened inside, without a span of its own
+@contextmanager
+def tagged(**tags):
+    stack = get_tag_stack()
+    stack.append(tags)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def span(name, **tags):
+    if not enabled:
+        return null_span
+    return timed_span(name, tags)
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_span = NullSpan()
+
+
+@contextmanager
+def timed_span(name, tags):
+    tags = dict(get_tags(), **tags)
+    # Spans opened inside inherit the tags
+    stack = get_tag_stack()
+    stack.append(tags)
+    profile = start_profile(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        stack.pop()
+        if profile is not None:
+            stop_profile(profile, name, tags)
+        record(name, tags, start, seconds)
+
+
+def timed(name):
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with timed_span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def get_tag_stack():
+    if not hasattr(context, 'tags'):
+        context.tags = []
+    return context.tags
+
+
+def get_tags():
+    tags = {}
+    for t in get_tag_stack():
+        tags.update(t)
+    return tags
+
+
+def record(name, tags, start, seconds):
+    with lock:
+        total = totals[(name, tuple(sorted(tags.items())))]
+        total[0] += 1
+        total[1] += seconds
+        if trace_path:
+            make_directory(trace_path)
+            line = dict(tags, name=name, start=start, seconds=seconds, pid=os.getpid())
+            with open(trace_path, 'a') as f:
+                f.write(json.dumps(line, default=str) + '\n')
+
+
+###############
+# Profiling
+###############
+# One profiler at a time: stages nested in a profiled stage are part of its profile
+def start_profile(name):
+    if name not in profile_stages or getattr(context, 'profiling', False):
+        return None
+    context.profiling = True
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            profile = Profiler()
+            profile.start()
+            return profile
+        except ImportError:
+            print('pyinstrument is not installed, profiling {} with cProfile'.format(name))
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stop_profile(profile, name, tags):
+    context.profiling = False
+    with lock:
+        profile_counts[name] += 1
+        file_path = get_profile_file_path(name, tags, profile_counts[name])
+    make_directory(file_path)
+    if isinstance(profile, cProfile.Profile):
+        profile.disable()
+        profile.dump_stats(file_path + '.prof')
+    else:
+        profile.stop()
+        with open(file_path + '.txt', 'w') as f:
+            f.write(profile.output_text())
+
+
+###############
+# Metrics
+###############
+# Prometheus text format of the span totals in this process
+def get_metrics():
+    lines = ['# TYPE app_span_seconds summary']
+    with lock:
+        items = sorted(totals.items())
+    for (name, tags), (count, seconds) in items:
+        labels = ','.join('{}="{}"'.format(k, escape_label(v)) for k, v in (('name', name),) + tags)
+        lines.append('app_span_seconds_sum{{{}}} {}'.format(labels, seconds))
+        lines.append('app_span_seconds_count{{{}}} {}'.format(labels, count))
+    return '\n'.join(lines) + '\n'
+
+
+def dump_metrics(file_path=None):
+    file_path = file_path or get_metrics_file_path()
+    if not totals or not file_path:
+        return
+    make_directory(file_path)
+    with open(file_path, 'w') as f:
+        f.write(get_metrics())
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def make_directory(file_path):
+    directory = os.path.dirname(file_path)
+    if directory and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process
+            pass
+
+
+###############
+# IO
+###############
+# Metrics of each process next to the trace file
+def get_metrics_file_path():
+    if not trace_path:
+        return None
+    return '{}.{}.prom'.format(os.path.splitext(trace_path)[0], os.getpid())
+
+
+def get_profile_file_path(name, tags, n):
+    suffix = '_'.join(str(v) for _, v in sorted(tags.items()))
+    file_name = '{}_{}_{}_{}'.format(name, suffix, os.getpid(), n).replace('/', '_')
+    return os.path.join('output/profile', file_name)
+
+
+atexit.register(dump_metrics)
+if trace_path or profile_stages:
+    enable()
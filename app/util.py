@@ -1,18 +1,22 @@
-from sklearn.metrics import precision_recall_curve, average_precision_score
-import matplotlib.pyplot as plt
-
-
+# matplotlib and sklearn are only imported when a curve is saved. Every curve has its own figure, without the
+# pyplot state, so curves can be rendered from report threads.
 def get_precision_recall_curve(ys, scores, file_path):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from sklearn.metrics import precision_recall_curve, average_precision_score
+
     average_precision = average_precision_score(ys, scores)
     precision, recall, _ = precision_recall_curve(ys, scores)
 
-    plt.step(recall, precision, color='b', alpha=0.2, where='post')
-    plt.fill_between(recall, precision, step='post', alpha=0.2, color='b')
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.step(recall, precision, color='b', alpha=0.2, where='post')
+    axes.fill_between(recall, precision, step='post', alpha=0.2, color='b')
 
-    plt.xlabel('Recall')
-    plt.ylabel('Precision')
-    plt.ylim([0.0, 1.05])
-    plt.xlim([0.0, 1.0])
-    plt.title('Precision-Recall Curve: AP={0:0.2f}'.format(average_precision))
-    plt.savefig(file_path)
-    plt.clf()
+    axes.set_xlabel('Recall')
+    axes.set_ylabel('Precision')
+    axes.set_ylim([0.0, 1.05])
+    axes.set_xlim([0.0, 1.0])
+    axes.set_title('Precision-Recall Curve: AP={0:0.2f}'.format(average_precision))
+    figure.savefig(file_path)